@@ -0,0 +1,369 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter, defaultdict
+
+import asyncpg
+from dotenv import load_dotenv
+
+from database import Database, DatabaseError
+from migrations import migrate
+from queries import QUERIES
+
+load_dotenv()
+
+BENCH_USER = 900000000000000001
+BENCH_TARGET = 900000000000000002
+
+# the registered queries each command runs, with sample arguments
+COMMANDS = {
+    "ichirob": [
+        ("econ_row", (BENCH_USER,)),
+        ("econ_row", (BENCH_TARGET,)),
+        ("transfer", (
+            [BENCH_USER, BENCH_TARGET], [4, -4], ["Benchmark", "Benchmark"],
+            [3, 0], [0, 0], [0.0, 0.0], BENCH_TARGET, 4, False, 0, True
+        )),
+    ],
+    "ichiheist": [
+        ("heist_target", (BENCH_TARGET, "LNC", 0)),
+        ("econ_row", (BENCH_USER,)),
+        ("transfer_from_bank", (
+            [BENCH_USER, BENCH_TARGET], [4, 0], ["Benchmark", None],
+            [1, 0], [0, 1], [0.0, 0.0], BENCH_TARGET, 4, False, 0, "LNC", True
+        )),
+    ],
+    "ichideposit": [
+        ("bank_move", (BENCH_USER, "LNC", 1000, 0, False, "Benchmark", True)),
+    ],
+    "ichiportfolio": [
+        ("portfolio", (BENCH_USER, 0)),
+    ],
+    "ichiledger": [
+        ("ledger_recent", (0, BENCH_USER, 3600)),
+    ],
+}
+
+
+class _Rollback(Exception):
+    pass
+
+
+async def _planning_ms(conn, name, args):
+    plan = await conn.fetchval(
+        f"EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) {QUERIES[name]}", *args
+    )
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Planning Time"]
+
+
+async def _time_command(conn, steps, statements, iterations):
+    # every iteration runs inside a rolled back transaction so the
+    # benchmark leaves the economy untouched
+    start = time.perf_counter()
+    for _ in range(iterations):
+        try:
+            async with conn.transaction():
+                for name, args in steps:
+                    if statements is None:
+                        await conn.fetch(QUERIES[name], *args)
+                    else:
+                        await statements[name].fetch(*args)
+                raise _Rollback()
+        except _Rollback:
+            pass
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+async def bench_prepared(dsn, ssl, iterations):
+    plain = await asyncpg.connect(dsn, ssl=ssl, statement_cache_size=0)
+    prepared = await asyncpg.connect(dsn, ssl=ssl)
+    report = {}
+    try:
+        statements = {name: await prepared.prepare(sql) for name, sql in QUERIES.items()}
+        for command, steps in COMMANDS.items():
+            planning = 0.0
+            try:
+                async with plain.transaction():
+                    for name, args in steps:
+                        planning += await _planning_ms(plain, name, args)
+                    raise _Rollback()
+            except _Rollback:
+                pass
+
+            unprepared_ms = await _time_command(plain, steps, None, iterations)
+            prepared_ms = await _time_command(prepared, steps, statements, iterations)
+            report[command] = {
+                "queries": len(steps),
+                "planning_ms": round(planning, 3),
+                "unprepared_ms": round(unprepared_ms, 3),
+                "prepared_ms": round(prepared_ms, 3),
+                "saved_ms": round(unprepared_ms - prepared_ms, 3),
+            }
+    finally:
+        await plain.close()
+        await prepared.close()
+
+    return report
+
+
+# synthetic users for the load generator; real Discord snowflakes are
+# many orders of magnitude larger
+LOAD_BASE = 1_000_000_000
+LOAD_BANK = "RDI"  # no withdrawal cooldown, so withdrawals don't just bounce
+
+
+async def _open_database(dsn, ssl, pool_size):
+    if dsn.startswith("sqlite:"):
+        from sqlitedb import SQLiteDatabase
+        return await SQLiteDatabase.open(dsn)
+    pool = await asyncpg.create_pool(
+        dsn, ssl=ssl, statement_cache_size=0, min_size=pool_size, max_size=pool_size
+    )
+    return Database(pool)
+
+
+async def _seed(db, users, now):
+    await migrate(db)
+    # a fresh database has no banks yet; these are RDI's real terms
+    await db.execute(
+        """
+        INSERT INTO banks
+            (BankName, ShortName, InterestRate, WithdrawalFee, MinimumDeposit,
+             SecurityModifier, MinimumDepositTime)
+        VALUES ('RadDogs Investments', $1, 1.00473, 0.025, 10000, 1, 0)
+        ON CONFLICT (ShortName) DO NOTHING
+        """,
+        LOAD_BANK
+    )
+    await db.change_balances((u, 10_000_000, "Benchmark seed", now) for u in users)
+    for u in users:
+        await db.execute(
+            """
+            INSERT INTO bankaccounts (UserID, BankType, Balance, LastDepositTime, SettledTick)
+            VALUES ($1, $2, $3, 0, (SELECT Tick FROM interestclock WHERE ID = 1))
+            ON CONFLICT (UserID, BankType) DO UPDATE SET
+                Balance = EXCLUDED.Balance, SettledTick = EXCLUDED.SettledTick
+            """,
+            u, LOAD_BANK, 1_000_000
+        )
+
+
+async def _cleanup(db, users):
+    await db.flush_ledger()
+    # one id at a time: sqlite keeps UserID as TEXT, where a range would
+    # compare as strings and catch real users too
+    for table in ("balancehistory", "passiveincome", "bankaccounts", "econ"):
+        for u in users:
+            await db.execute(f"DELETE FROM {table} WHERE UserID = $1", u)
+
+
+# Each operation issues the same Database calls as its Economy command.
+
+async def _op_rob(db, rng, users, now):
+    robber, target = rng.sample(users, 2)
+    await db.econ_row(robber)
+    row = await db.econ_row(target)
+    amount = max(1, min(row["balance"] // 25, 100000))
+    return await db.transfer(
+        target, robber, amount,
+        (f"Balance stolen by {robber}", f"Balance stolen from {target}"),
+        side_effects={robber: {"Wantedness": 3, "LastStealTime": now}},
+        time=now
+    )
+
+
+async def _op_heist(db, rng, users, now):
+    robber, target = rng.sample(users, 2)
+    account = await db.fetchone("heist_target", target, LOAD_BANK, int(now))
+    await db.econ_row(robber)
+    return await db.transfer(
+        target, robber, max(1, account[1] // 5), (None, f"Bank Heist from {target}"),
+        side_effects={robber: {"Wantedness": 1}, target: {"Alertness": 1}},
+        time=now, bank=LOAD_BANK
+    )
+
+
+async def _op_transfer(db, rng, users, now):
+    sender, receiver = rng.sample(users, 2)
+    return await db.transfer(
+        sender, receiver, rng.randint(1, 1000),
+        (f"Transfer to {receiver}", f"Transfer from {sender}"), time=now
+    )
+
+
+async def _op_deposit(db, rng, users, now):
+    return await db.bank_deposit(rng.choice(users), rng.randint(10000, 20000), now, LOAD_BANK, 0)
+
+
+async def _op_withdraw(db, rng, users, now):
+    return await db.bank_deposit(rng.choice(users), -rng.randint(1, 10000), now, LOAD_BANK, 0)
+
+
+async def _op_portfolio(db, rng, users, now):
+    return await db.portfolio(rng.choice(users), now)
+
+
+async def _op_rank(db, rng, users, now):
+    ranks = await db.ranking()
+    return ranks.around("networth", rng.choice(users))
+
+
+LOAD_OPS = {
+    "rob": _op_rob,
+    "heist": _op_heist,
+    "transfer": _op_transfer,
+    "deposit": _op_deposit,
+    "withdraw": _op_withdraw,
+    "portfolio": _op_portfolio,
+    "rank": _op_rank,
+}
+
+
+def _parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in LOAD_OPS:
+            raise ValueError(f"unknown operation {name!r}, expected one of {', '.join(LOAD_OPS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def pick(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+async def bench_load(dsn, ssl, users, rate, duration, concurrency, mix, seed):
+    """Replay a weighted mix of economy operations at a fixed arrival rate.
+
+    Arrivals are scheduled open-loop, so a slow database shows up as
+    latency (measured from each operation's scheduled start) rather than
+    as a quietly lower request rate.
+    """
+    db = await _open_database(dsn, ssl, concurrency)
+    rng = random.Random(seed)
+    ids = [LOAD_BASE + i for i in range(users)]
+    names, weights = zip(*_parse_mix(mix).items())
+
+    latencies = defaultdict(list)
+    outcomes = Counter()
+    errors = Counter()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run(name, scheduled):
+        async with slots:
+            try:
+                result = await LOAD_OPS[name](db, rng, ids, int(time.time()))
+            except asyncpg.DeadlockDetectedError:
+                outcomes["deadlock"] += 1
+                return
+            except Exception as e:
+                errors[type(e).__name__] += 1
+                outcomes["error"] += 1
+                return
+        latencies[name].append(time.perf_counter() - scheduled)
+        # a DatabaseError result is the economy saying no (e.g. no funds)
+        outcomes["rejected" if isinstance(result, DatabaseError) else "ok"] += 1
+
+    try:
+        await _seed(db, ids, int(time.time()))
+        tasks = []
+        start = time.perf_counter()
+        for i in range(int(rate * duration)):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name = rng.choices(names, weights)[0]
+            tasks.append(asyncio.create_task(run(name, scheduled)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        stats = db.stats()
+    finally:
+        await _cleanup(db, ids)
+        await db.close()
+
+    completed = sum(len(samples) for samples in latencies.values())
+    return {
+        "backend": getattr(db, "dialect", "postgres"),
+        "users": users,
+        "concurrency": concurrency,
+        "mix": dict(zip(names, weights)),
+        "target_rate": rate,
+        "achieved_rate": round(completed / elapsed, 2) if elapsed else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "outcomes": dict(outcomes),
+        "errors": dict(errors),
+        "deadlocks": outcomes["deadlock"],
+        "latency": {
+            "all": _percentiles([s for samples in latencies.values() for s in samples]),
+            **{name: _percentiles(latencies[name]) for name in names},
+        },
+        "database": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Economy database benchmarks")
+    parser.add_argument("--dsn", default=os.getenv("POSTGRESQL") or os.getenv("DATABASE_URL"))
+    parser.add_argument("--ssl", default="prefer", help="asyncpg ssl mode (disable/prefer/require)")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    prepared = sub.add_parser("prepared", help="Planning time saved by prepared statements, per command")
+    prepared.add_argument("--iterations", type=int, default=200)
+
+    load = sub.add_parser(
+        "load",
+        help="Throughput and latency of a mix of economy operations; "
+             "the DSN may be sqlite:///economy.db"
+    )
+    load.add_argument("--users", type=int, default=1000)
+    load.add_argument("--rate", type=float, default=200, help="operations per second")
+    load.add_argument("--duration", type=float, default=30, help="seconds")
+    load.add_argument("--concurrency", type=int, default=20, help="operations in flight (and pool size)")
+    load.add_argument(
+        "--mix", default="rob=3,transfer=4,deposit=2,withdraw=2,heist=1,portfolio=2,rank=2",
+        help="comma separated operation=weight"
+    )
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--output", help="also write the report to this file")
+
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("no DSN given and POSTGRESQL/DATABASE_URL is not set")
+    ssl = False if args.ssl == "disable" else args.ssl
+
+    if args.benchmark == "prepared":
+        report = asyncio.run(bench_prepared(args.dsn, ssl, args.iterations))
+    elif args.benchmark == "load":
+        report = asyncio.run(bench_load(
+            args.dsn, ssl, args.users, args.rate, args.duration,
+            args.concurrency, args.mix, args.seed
+        ))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=4)
+
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
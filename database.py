@@ -1,15 +1,197 @@
+import asyncio
+import contextlib
+import csv
+import dataclasses
+import datetime
+import gzip
+import io
+import json
 import os
+import re
+import secrets
+from time import monotonic
 import asyncpg
 from dotenv import load_dotenv
+from dbcache import EconCache
+from dbpool import PoolMonitor, pool_bounds
+from dbrank import RankIndex
+from ledger import LedgerQueue
+from queries import QUERIES
 load_dotenv()
 
+# econ counters Database.transfer may bump as a side effect
+COUNTER_COLUMNS = ("Wantedness", "Alertness")
+
+_TOUCHES_ECON = re.compile(r"\becon\b", re.IGNORECASE)
+_TOUCHES_BANKS = re.compile(r"\bbanks\b", re.IGNORECASE)
+# anything that can move a wallet or a settled bank balance
+_TOUCHES_RANKS = re.compile(r"\b(econ|bankaccounts|interestclock)\b", re.IGNORECASE)
+_WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE)
+
+# the notify_econ_cache trigger (migration 5) publishes writes here
+CACHE_CHANNEL = "econ_cache"
+
+# columns of the ledger_export query, in order
+EXPORT_COLUMNS = ("UserID", "BalanceChange", "BalanceAfter", "Timestamp", "Reason")
+
 #fuck it we ball 
 class DatabaseError(Exception):
     pass
 
+@dataclasses.dataclass(frozen=True)
+class Portfolio:
+    """What /ichiportfolio shows: wallet, {bank ShortName: balance} for
+    every bank, and the Wanted level right now."""
+    wallet: int
+    banks: dict
+    wanted: int
+
+    @property
+    def bank_total(self):
+        return sum(self.banks.values())
+
+    @property
+    def net_worth(self):
+        return self.wallet + self.bank_total
+
+def heat(value, updated, now):
+    # Wantedness/Alertness as of now: a point wears off per full hour since
+    # it was last raised at updated, like the heat() SQL function
+    return max(0, value - max(0, int(now - updated)) // 3600)
+
+def month_bounds(timestamp):
+    # (start, end, "YYYY_MM") of the UTC month holding timestamp
+    start = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return int(start.timestamp()), int(end.timestamp()), start.strftime("%Y_%m")
+
+def _encode_export(rows, fmt):
+    if fmt == "ndjson":
+        return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
 class Database:
-    def __init__(self, pool: asyncpg.Pool):
+    dialect = "postgres"
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        prepared: bool = False,
+        dsn: str = None,
+        replica_pool: asyncpg.Pool = None
+    ):
+        self.prepared = prepared
+        self.dsn = dsn
+        self.autotune = os.getenv("DB_POOL_AUTOTUNE", "0") == "1"
+        self.pool = None
+        self.monitor = None
+        # optional read replica: reads passed consistent=False go there
+        # unless it lags more than replica_max_lag seconds
+        self.replica_dsn = None
+        self.replica_pool = None
+        self.replica_monitor = None
+        self.replica_lag = None
+        self.replica_max_lag = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+        self._replica_watcher = None
+        self._writes = {}
+        self.cache = EconCache()
+        # application_name of every connection we open; the cache triggers
+        # report it, so we can skip notifications about our own writes
+        self.origin = (
+            f"{os.getenv('DB_APPLICATION_NAME', 'economy-bot')}/{secrets.token_hex(4)}"
+        )
+        self._banks = None
+        self._banks_version = 0
+        # leaderboards, loaded on first use; users other processes wrote
+        # are read back before the next lookup
+        self.ranks = RankIndex()
+        self._ranks_lock = asyncio.Lock()
+        self._rank_dirty = set()
+        self._listener = None
+        self.listening = False
+        self.notifications = 0
+        # set once warm_up() has opened and checked the pool's connections
+        self.ready = asyncio.Event()
+        # balancehistory rows are written behind the balance updates unless
+        # LEDGER_WRITE_BEHIND=0, in which case each statement writes its own
+        self.ledger = None
+        if os.getenv("LEDGER_WRITE_BEHIND", "1") == "1":
+            self.ledger = LedgerQueue(self._insert_ledger)
+        # passive income is logged as one passiveincome row per user per bucket
+        self.income_bucket = int(os.getenv("PASSIVE_INCOME_BUCKET", "3600"))
+        # balancehistory keeps this many days; older rows go to the archive
+        self.retention = int(os.getenv("LEDGER_RETENTION_DAYS", "90")) * 86400
+        self.archive_batch = int(os.getenv("ARCHIVE_BATCH_ROWS", "1000"))
+        self.archive_pause = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.5"))
+        self.export_chunk = int(os.getenv("LEDGER_EXPORT_CHUNK", "1000"))
+        self.check_batch = int(os.getenv("LEDGER_CHECK_BATCH", "500"))
+        self.check_workers = int(os.getenv("LEDGER_CHECK_WORKERS", "4"))
+        # bank accounts this many interest ticks behind are settled by
+        # settle_accounts(), settle_batch per transaction
+        self.settle_after = int(os.getenv("BANK_SETTLE_AFTER_TICKS", "24"))
+        self.settle_batch = int(os.getenv("BANK_SETTLE_BATCH", "1000"))
+        if pool is not None:
+            self._set_pool(pool)
+        if replica_pool is not None:
+            self._set_replica(replica_pool)
+
+    def _set_pool(self, pool: asyncpg.Pool):
+        if self.monitor is not None:
+            self.monitor.stop()
         self.pool = pool
+        self.monitor = PoolMonitor(pool, self.autotune)
+        self.monitor.start()
+
+    def _set_replica(self, pool: asyncpg.Pool):
+        if self.replica_monitor is not None:
+            self.replica_monitor.stop()
+        self.replica_pool = pool
+        self.replica_monitor = PoolMonitor(pool, self.autotune)
+        self.replica_monitor.start()
+        if self._replica_watcher is None:
+            self._replica_watcher = asyncio.create_task(self._watch_replica())
+
+    async def _watch_replica(self, interval: float = 2.0):
+        while True:
+            try:
+                async with self.replica_monitor.acquire() as conn:
+                    self.replica_lag = float(await conn.fetchval(QUERIES["replica_lag"]))
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                if self.replica_lag is not None:
+                    print(f"Read replica unavailable, reading from the primary: {e}")
+                self.replica_lag = None
+            await asyncio.sleep(interval)
+
+    def _use_replica(self, query: str, consistent: bool):
+        return (
+            not consistent
+            and self.replica_lag is not None
+            and self.replica_lag <= self.replica_max_lag
+            and not _WRITES.search(query)
+        )
+
+    def _wrote(self, *userIDs):
+        # remembered for wrote_recently(); forgotten once any replica
+        # that is still in use must have caught up
+        now = monotonic()
+        for userID in userIDs:
+            self._writes[userID] = now
+        if len(self._writes) > 10000:
+            self._writes = {
+                u: t for u, t in self._writes.items() if now - t < self.replica_max_lag
+            }
+
+    def wrote_recently(self, userID):
+        """True if userID's own last write may not have reached the replica yet.
+
+        Pass it as consistent= on reads that should show that write.
+        """
+        wrote = self._writes.get(userID)
+        return wrote is not None and monotonic() - wrote < self.replica_max_lag
 
     @classmethod
     async def create(cls):
@@ -23,71 +205,784 @@ class Database:
 
         dsn = dsn.strip()
 
-        pool = await asyncpg.create_pool(
-            dsn,
-            ssl="require",
-            statement_cache_size=0
+        if dsn.startswith("sqlite:"):
+            from sqlitedb import SQLiteDatabase
+            return await SQLiteDatabase.open(dsn)
+
+        # Only safe when connecting straight to Postgres: a transaction-mode
+        # pooler (pgbouncer) moves us between backends that never saw our PREPAREs.
+        prepared = os.getenv("DB_PREPARED_STATEMENTS", "0") == "1"
+        if prepared and await cls._behind_pooler(dsn):
+            print("Connection pooler detected, prepared statements disabled.")
+            prepared = False
+
+        db = cls(None, prepared, dsn)
+        db._set_pool(await db._create_pool())
+
+        replica_dsn = os.getenv("POSTGRESQL_REPLICA") or os.getenv("DATABASE_REPLICA_URL")
+        if replica_dsn:
+            db.replica_dsn = replica_dsn.strip()
+            db._set_replica(await db._create_pool(db.replica_dsn))
+
+        if os.getenv("DB_CACHE_LISTEN", "1") == "1":
+            db.start_listener()
+
+        return db
+
+    def start_listener(self):
+        # LISTEN needs a session of its own, so behind a transaction-mode
+        # pooler point DB_LISTEN_URL straight at Postgres
+        if self._listener is None:
+            self._listener = asyncio.create_task(
+                self._listen(os.getenv("DB_LISTEN_URL") or self.dsn)
+            )
+
+    async def _listen(self, dsn: str):
+        delay = 1
+        while True:
+            try:
+                conn = await asyncpg.connect(
+                    dsn, ssl="require", statement_cache_size=0,
+                    server_settings={"application_name": self.origin}
+                )
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+                print(f"Cache listener can't connect, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+
+            delay = 1
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda _: lost.set())
+            try:
+                await conn.add_listener(CACHE_CHANNEL, self._on_notify)
+                # whatever changed while nobody was listening went unheard
+                self._reset_caches()
+                self.listening = True
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), 30)
+                    except asyncio.TimeoutError:
+                        # a dead peer doesn't always close the socket
+                        await conn.fetchval("SELECT 1", timeout=10)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                print(f"Cache listener error: {e}")
+            finally:
+                self.listening = False
+                conn.terminate()
+            print("Cache listener disconnected, reconnecting")
+            self._reset_caches()
+
+    def _on_notify(self, conn, pid, channel, payload):
+        event = json.loads(payload)
+        if event["origin"] == self.origin:
+            # already patched from our own RETURNING values
+            return
+        self.notifications += 1
+        if event["table"] == "banks":
+            self._forget_banks()
+            return
+        if event["table"] == "econ":
+            if event["ids"] is None:
+                self.cache.invalidate()
+            else:
+                for userID in event["ids"]:
+                    self.cache.invalidate(userID)
+        if event["ids"] is None:
+            self._forget_ranks()
+        else:
+            self._rank_dirty.update(event["ids"])
+
+    def _forget_banks(self):
+        self._banks = None
+        self._banks_version += 1
+
+    def _forget_ranks(self):
+        self.ranks.clear()
+        self._rank_dirty.clear()
+
+    def _reset_caches(self):
+        self.cache.invalidate()
+        self._forget_banks()
+        self._forget_ranks()
+
+    async def _create_pool(self, dsn: str = None):
+        min_size, max_size = pool_bounds()
+        options = {
+            "ssl": "require",
+            "min_size": min_size,
+            "max_size": max_size,
+            "max_inactive_connection_lifetime": float(
+                os.getenv("DB_POOL_IDLE_LIFETIME", "300")
+            ),
+            # session settings ride along with the startup packet
+            "server_settings": {
+                "application_name": self.origin,
+            },
+            "init": self._init_connection,
+        }
+
+        if not self.prepared:
+            return await asyncpg.create_pool(
+                dsn or self.dsn,
+                statement_cache_size=0,
+                **options
+            )
+
+        # room for every registry query; each is prepared on first use
+        return await asyncpg.create_pool(
+            dsn or self.dsn,
+            statement_cache_size=max(100, 2 * len(QUERIES)),
+            **options
+        )
+
+    @staticmethod
+    async def _behind_pooler(dsn: str):
+        if "pgbouncer" in dsn.lower() or ":6432/" in dsn:
+            return True
+
+        conn = await asyncpg.connect(dsn, ssl="require", statement_cache_size=0)
+        try:
+            # pgbouncer in transaction mode hands each transaction to whichever
+            # backend is free, so the backend pid is not stable
+            pids = set()
+            for _ in range(5):
+                pids.add(await conn.fetchval("SELECT pg_backend_pid()"))
+            return pids != {conn.get_server_pid()}
+        finally:
+            await conn.close()
+
+    async def _init_connection(self, conn):
+        # runs once for every new pooled connection
+        for type_name in ("json", "jsonb"):
+            await conn.set_type_codec(
+                type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+            )
+
+    async def warm_up(self, progress=None):
+        """Open and ping the pool's minimum connections before taking commands.
+
+        asyncpg reconnects lazily, both at startup and after idle connections
+        are closed, so without this the first commands pay for the TLS
+        handshake and the init hook. progress(done, total) is called as each
+        connection checks out. ready is clear while it runs, so database
+        commands wait for it, and set again however it ends: a warm-up that
+        fails must not lock every command out.
+        """
+        self.ready.clear()
+        try:
+            await self._check_out_all(progress)
+        finally:
+            self.ready.set()
+
+    async def _check_out_all(self, progress):
+        pools = [p for p in (self.pool, self.replica_pool) if p is not None]
+        total = sum(p.get_min_size() for p in pools)
+        done = 0
+
+        async def check_out(pool):
+            nonlocal done
+            conn = await pool.acquire()
+            try:
+                await conn.fetchval("SELECT 1")
+            except (OSError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError):
+                # dead socket: throw it away and let the pool open a new one
+                conn.terminate()
+                await pool.release(conn)
+                conn = await pool.acquire()
+                await conn.fetchval("SELECT 1")
+            done += 1
+            if progress is not None:
+                progress(done, total)
+            return pool, conn
+
+        # hold them all at once so each acquire opens a different connection
+        results = await asyncio.gather(
+            *(check_out(p) for p in pools for _ in range(p.get_min_size())),
+            return_exceptions=True
         )
+        for result in results:
+            if not isinstance(result, BaseException):
+                await result[0].release(result[1])
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _disable_prepared(self):
+        print("Prepared statement missing, falling back to unprepared queries.")
+        self.prepared = False
+        old_pool = self.pool
+        self._set_pool(await self._create_pool())
+        await old_pool.close()
+        if self.replica_pool is not None:
+            old_pool = self.replica_pool
+            self._set_replica(await self._create_pool(self.replica_dsn))
+            await old_pool.close()
 
-        return cls(pool)
+    async def _run(self, method: str, query: str, args, consistent: bool = True):
+        query = QUERIES.get(query, query)
+        replica = self._use_replica(query, consistent)
+        monitor = self.replica_monitor if replica else self.monitor
+        try:
+            async with monitor.acquire() as conn:
+                return await getattr(conn, method)(query, *args)
+        except asyncpg.exceptions.InvalidSQLStatementNameError:
+            # the statement vanished under us, which is what a pooler in
+            # front of Postgres looks like
+            if not self.prepared:
+                raise
+            await self._disable_prepared()
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError):
+            if not replica:
+                raise
+            # replica went away mid-query; the watcher brings it back
+            self.replica_lag = None
+        async with self.acquire() as conn:
+            return await getattr(conn, method)(query, *args)
+
+    def acquire(self):
+        return self.monitor.acquire()
+
+    def stats(self):
+        stats = self.monitor.snapshot()
+        if self.replica_monitor is not None:
+            stats["replica"] = self.replica_monitor.snapshot()
+            stats["replica"]["lag_s"] = self.replica_lag
+        stats["cache"] = self.cache.snapshot()
+        stats["cache"]["listening"] = self.listening
+        stats["cache"]["notifications"] = self.notifications
+        stats["ranks"] = self.ranks.snapshot()
+        if self.ledger is not None:
+            stats["ledger"] = self.ledger.snapshot()
+        return stats
+
+    def _invalidate_for(self, query: str, done: bool = False):
+        # raw writes don't tell us which rows changed. Called before the
+        # write and again once it's done: a read that misses in between can
+        # cache a row as it was before the write committed, and our own
+        # notifications are ignored, so nothing else would drop it.
+        query = QUERIES.get(query, query)
+        if _TOUCHES_ECON.search(query):
+            self.cache.invalidate()
+        if _TOUCHES_BANKS.search(query):
+            self._forget_banks()
+        # dropping the rank index early only invites a reload from before
+        # the write (the interest tick, say), so it waits until it's done
+        if done and _TOUCHES_RANKS.search(query):
+            self._forget_ranks()
 
     async def execute(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.execute(query, *args)
+        self._invalidate_for(query)
+        try:
+            return await self._run("execute", query, args)
+        finally:
+            self._invalidate_for(query, done=True)
 
-    async def fetchone(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow(query, *args)
+    # Reads stay on the primary unless the caller opts into the replica with
+    # consistent=False. Only do that for reads that just feed a reply: a
+    # check-then-write against a lagging replica can pass twice.
+    async def fetchone(self, query: str, *args, consistent: bool = True):
+        return await self._run("fetchrow", query, args, consistent)
 
-    async def fetchall(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.fetch(query, *args)
+    async def fetchall(self, query: str, *args, consistent: bool = True):
+        return await self._run("fetch", query, args, consistent)
 
     async def write(self, query: str, *args):
         print(f"Executing query: {query}")
         print(f"Parameters: {args}")
 
-        async with self.pool.acquire() as conn:
-            result = await conn.execute(query, *args)
+        self._invalidate_for(query)
+        try:
+            result = await self._run("execute", query, args)
+        finally:
+            self._invalidate_for(query, done=True)
 
         print("Query executed successfully.")
         return result
 
-    async def change_balance(self, userID, value, reason, time):
-        checkif = await self.fetchone(
-            "SELECT * FROM econ WHERE UserID = $1",
-            userID
+    async def fetchval(self, query: str, *args, consistent: bool = True):
+        return await self._run("fetchval", query, args, consistent)
+
+    async def sequential_scans(self, query: str, *args):
+        # tables the planner would read in full; seqscan is discouraged so
+        # small tables still show whether a usable index exists
+        async with self.transaction() as conn:
+            await conn.execute("SET LOCAL enable_seqscan = off")
+            plan = await conn.fetchval(
+                f"EXPLAIN (FORMAT JSON) {QUERIES.get(query, query)}", *args
+            )
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        tables = []
+        nodes = [plan[0]["Plan"]]
+        while nodes:
+            node = nodes.pop()
+            if node["Node Type"] == "Seq Scan":
+                tables.append(node["Relation Name"])
+            nodes.extend(node.get("Plans", ()))
+        return tables
+
+    async def _insert_ledger(self, rows):
+        async with self.acquire() as conn:
+            await conn.copy_records_to_table(
+                "balancehistory",
+                records=rows,
+                columns=["userid", "balancechange", "balanceafter", "timestamp", "reason"]
+            )
+
+    async def _log(self, rows):
+        if self.ledger is not None:
+            await self.ledger.put(rows)
+
+    async def flush_ledger(self):
+        # make every ledger row written so far visible to readers
+        if self.ledger is None:
+            return 0
+        return await self.ledger.flush()
+
+    async def recent_ledger(self, userID, since):
+        # the user's latest rows may still be waiting in the write-behind queue;
+        # once flushed they're on the primary only
+        flushed = await self.flush_ledger()
+        return await self.fetchall(
+            "ledger_recent", since, userID, self.income_bucket,
+            consistent=bool(flushed) or self.wrote_recently(userID)
+        )
+
+    async def archive_ledger(self, now, max_batches=100):
+        """Move balancehistory rows past the retention window to the archive.
+
+        Works in batches of archive_batch rows, each its own short
+        transaction, with a pause between them so chat traffic never queues
+        behind the archiver. Returns the number of rows moved.
+        """
+        cutoff = now - self.retention
+        moved = 0
+        for _ in range(max_batches):
+            # a short batch may just be the end of a month, so only an
+            # empty one means we're done
+            count = await self._archive_batch(cutoff, self.archive_batch)
+            if not count:
+                break
+            moved += count
+            await asyncio.sleep(self.archive_pause)
+        return moved
+
+    async def _archive_batch(self, cutoff, limit):
+        oldest = await self.fetchval("ledger_oldest", consistent=True)
+        if oldest is None or oldest >= cutoff:
+            return 0
+
+        # one month per batch, so the partition it lands in is known to exist
+        start, end, month = month_bounds(oldest)
+        await self.execute(
+            f"CREATE TABLE IF NOT EXISTS balancehistory_archive_{month} "
+            f"PARTITION OF balancehistory_archive FOR VALUES FROM ({start}) TO ({end})"
         )
+        return await self.fetchval("archive_ledger_batch", min(cutoff, end), limit)
+
+    async def settle_accounts(self, max_batches=100):
+        """Settle bank accounts left settle_after or more ticks behind.
+
+        bankaccounts_live runs one settle_interest() step per unsettled tick
+        on every read, so an idle account would cost a little more every
+        hour. This caps it at settle_after. Works in batches like
+        archive_ledger; the balances shown don't change, so no cache is
+        dropped. Returns the number of accounts settled.
+        """
+        settled = 0
+        for _ in range(max_batches):
+            count = await self._settle_batch(self.settle_after, self.settle_batch)
+            if not count:
+                break
+            settled += count
+            await asyncio.sleep(self.archive_pause)
+        return settled
+
+    async def _settle_batch(self, after, limit):
+        return await self.fetchval("settle_stale_accounts", after, limit)
+
+    async def export_ledger(self, out, userID=None, fmt="csv", chunk_rows=None):
+        """Write the ledger to out (a binary file) as gzipped CSV or NDJSON.
+
+        Covers balancehistory, its archive and the passive income rollups,
+        oldest first, for one user or everyone. Rows are read chunk_rows at a
+        time through a server-side cursor and compressed as they arrive, so
+        memory use doesn't grow with the history. Returns the row count.
+        """
+        if fmt not in ("csv", "ndjson"):
+            raise ValueError(f"Unknown export format {fmt!r}")
 
-        if checkif is None:
-            await self.write(
-                "INSERT INTO econ (UserID) VALUES ($1)",
-                userID
+        flushed = await self.flush_ledger()
+        count = 0
+        with gzip.GzipFile(fileobj=out, mode="wb") as archive:
+            if fmt == "csv":
+                archive.write(_encode_export([EXPORT_COLUMNS], fmt).encode())
+            async for rows in self._stream(
+                "ledger_export", (userID,), chunk_rows or self.export_chunk,
+                consistent=bool(flushed)
+            ):
+                archive.write(_encode_export(rows, fmt).encode())
+                count += len(rows)
+        return count
+
+    async def _stream(self, query: str, args, chunk_rows: int, consistent: bool = True):
+        # yields lists of up to chunk_rows records; cursors need a transaction
+        query = QUERIES.get(query, query)
+        monitor = self.replica_monitor if self._use_replica(query, consistent) else self.monitor
+        async with monitor.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                cursor = await conn.cursor(query, *args)
+                while True:
+                    rows = await cursor.fetch(chunk_rows)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def check_ledger(
+        self, now, batch_size=None, workers=None, recheck_delay=2.0, settle_delay=2.0
+    ):
+        """Compare every econ balance with its ledger; returns the mismatches.
+
+        Each user has a checkpoint in ledgercheckpoints: the balance last
+        verified and the newest ledger row it covered, so only rows written
+        since are summed. Users go batch_size at a time, workers batches at
+        once.
+
+        HistoryIDs are handed out before their rows commit, so a row can
+        become visible after one with a higher id. Checkpoints therefore stop
+        at the newest row that existed settle_delay before the batches read;
+        anything past that is summed again next time.
+
+        A balance can be ahead of its write-behind ledger rows for a moment,
+        so users that don't add up are checked again after recheck_delay.
+        Those that still don't come back as {"userid", "balance",
+        "expected", "rows"}, rows being the ledger rows since the checkpoint,
+        and are re-baselined at their current balance so each drift is
+        reported once. Users never checked before may hold coins from before
+        the ledger, so their first check only takes the baseline.
+        """
+        batch_size = batch_size or self.check_batch
+        limit = asyncio.Semaphore(workers or self.check_workers)
+        await self.flush_ledger()
+        horizon = await self.fetchval("ledger_check_horizon")
+        await asyncio.sleep(settle_delay)
+        userIDs = [row[0] for row in await self.fetchall("ledger_check_users", consistent=True)]
+        suspects = []
+
+        async def check(batch):
+            async with limit:
+                rows = await self._check_batch(batch, horizon)
+                suspects.extend(r["userid"] for r in rows if r["balance"] != r["expected"])
+                await self._save_checkpoints(
+                    [r for r in rows if r["balance"] == r["expected"]], now
+                )
+
+        await asyncio.gather(*(
+            check(userIDs[i:i + batch_size]) for i in range(0, len(userIDs), batch_size)
+        ))
+        if not suspects:
+            return []
+
+        await asyncio.sleep(recheck_delay)
+        await self.flush_ledger()
+        rows = await self._check_batch(suspects, horizon)
+        mismatches = []
+        for row in rows:
+            if row["balance"] == row["expected"] or not row["checked"]:
+                continue
+            history = await self.fetchall(
+                "ledger_check_rows", row["userid"], row["checkedid"], row["checkedbucket"],
+                consistent=True
             )
+            mismatches.append({
+                "userid": row["userid"],
+                "balance": row["balance"],
+                "expected": row["expected"],
+                "rows": [dict(r) for r in history],
+            })
+        await self._save_checkpoints(rows, now)
+        return mismatches
+
+    async def _check_batch(self, userIDs, horizon):
+        return await self.fetchall("ledger_check_batch", userIDs, horizon, consistent=True)
 
-        await self.write(
-            "UPDATE econ SET Balance = Balance + $1 WHERE UserID = $2",
-            value,
-            userID
+    async def _save_checkpoints(self, rows, now):
+        # the balance is what was verified (or, for a mismatch, accepted),
+        # less the rows past the horizon
+        if not rows:
+            return
+        await self.execute(
+            "ledger_checkpoint_save",
+            [r["userid"] for r in rows],
+            [r["historyid"] for r in rows],
+            [r["bucket"] for r in rows],
+            [r["bucketamount"] for r in rows],
+            [r["balance"] - r["pending"] for r in rows],
+            int(now)
         )
 
-        new_balance = await self.fetchone(
-            "SELECT Balance FROM econ WHERE UserID = $1",
-            userID
+    async def ledger_partitions(self):
+        # [{"name", "rows", "bytes"}] for the live table and each archive month
+        rows = await self.fetchall("ledger_partitions", consistent=False)
+        return [{"name": r["name"], "rows": r["rows"], "bytes": r["bytes"]} for r in rows]
+
+    async def banks(self):
+        # {ShortName: row} for every bank; other processes' edits to the
+        # table arrive as notifications and drop it
+        if self._banks is None:
+            version = self._banks_version
+            rows = await self.fetchall("banks_all", consistent=True)
+            banks = {row["shortname"]: dict(row) for row in rows}
+            if version != self._banks_version:
+                # changed while we were reading
+                return banks
+            self._banks = banks
+        return self._banks
+
+    async def ranking(self):
+        """The RankIndex, up to date.
+
+        Loaded with one query the first time (and after a raw write or a
+        lost notification dropped it); after that only users another
+        process wrote are read back, so most lookups run no query at all.
+        """
+        async with self._ranks_lock:
+            ranks = self.ranks
+            if self._rank_dirty and ranks.loaded:
+                userIDs = list(self._rank_dirty)
+                self._rank_dirty.clear()
+                generation = ranks.generation
+                ranks.start_load()
+                try:
+                    rows = await self.fetchall("rank_users", userIDs, consistent=True)
+                except BaseException:
+                    ranks.clear()
+                    raise
+                if ranks.generation == generation:
+                    ranks.load(rows, userIDs)
+
+            for attempt in range(3):
+                if ranks.loaded:
+                    break
+                generation = ranks.generation
+                # anyone notified about so far is in what we're about to read
+                self._rank_dirty.clear()
+                ranks.start_load()
+                try:
+                    rows = await self.fetchall("rank_all", consistent=True)
+                except BaseException:
+                    ranks.clear()
+                    raise
+                # a raw write while it ran may be missing from rows; go
+                # again, but not forever
+                if ranks.generation == generation:
+                    ranks.load(rows)
+                elif attempt == 2:
+                    # still racing raw writes: serve these rows this once
+                    # and read again next time
+                    ranks.load(rows)
+                    ranks.loaded = False
+        return ranks
+
+    async def econ_row(self, userID):
+        # read-through: the whole econ row, from the cache when we have it
+        row = self.cache.get(userID)
+        if row is not None:
+            return row
+
+        # the cache is patched from the primary, so it's filled from there too
+        generation = self.cache.generation
+        row = await self.fetchone("econ_row", userID, consistent=True)
+        if row is None:
+            return None
+        if self.cache.generation != generation:
+            # invalidated while we were reading; this row may be the old one
+            return dict(row)
+        self.cache.put(userID, row)
+        return self.cache.rows[userID]
+
+    async def portfolio(self, userID, time, consistent=False):
+        # one round trip whatever the number of banks
+        rows = await self.fetchall("portfolio", userID, int(time), consistent=consistent)
+        return Portfolio(
+            wallet=rows[0]["wallet"],
+            banks={row["banktype"]: row["balance"] for row in rows if row["banktype"] is not None},
+            wanted=rows[0]["wanted"]
         )
 
-        await self.write(
-            """
-            INSERT INTO balancehistory
-                (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
-            VALUES ($1, $2, $3, $4, $5)
-            """,
-            userID,
-            value,
-            new_balance[0],
-            time,
-            reason
+    async def change_balance(self, userID, value, reason, time):
+        time = int(time)
+        balance = await self._apply_change_balance(
+            userID, value, reason, time, self.ledger is None
         )
+        self.cache.patch(userID, balance=balance)
+        self.ranks.set_wallet(userID, balance)
+        self._wrote(userID)
+        await self._log([(userID, value, balance, time, reason)])
+        return balance
+
+    async def _apply_change_balance(self, userID, value, reason, time, ledger):
+        # upsert (+ ledger row when ledger is set) in one statement
+        return await self.fetchval("change_balance", userID, value, time, reason, ledger)
+
+    async def change_balances(self, changes):
+        # changes: iterable of (userID, value, reason, time); returns {userID: new balance}
+        changes = list(changes)
+        if not changes:
+            return {}
+
+        changes = [(c[0], c[1], c[2], int(c[3])) for c in changes]
+        balances = await self._apply_change_balances(changes, self.ledger is None)
+        for userID, balance in balances.items():
+            self.cache.patch(userID, balance=balance)
+            self.ranks.set_wallet(userID, balance)
+        self._wrote(*balances)
+
+        if self.ledger is not None:
+            # walk each user's final balance back to get the running one
+            running = dict(balances)
+            for userID, value, _, _ in changes:
+                running[userID] -= value
+            rows = []
+            for userID, value, reason, at in changes:
+                running[userID] += value
+                rows.append((userID, value, running[userID], at, reason))
+            await self._log(rows)
+        return balances
+
+    async def _apply_change_balances(self, changes, ledger):
+        rows = await self.fetchall(
+            "change_balances",
+            [c[0] for c in changes],
+            [c[1] for c in changes],
+            [c[2] for c in changes],
+            [c[3] for c in changes],
+            ledger
+        )
+        return {row[0]: row[1] for row in rows}
+
+    async def add_passive_income(self, credits, time):
+        # credits: {userID: amount}, all in one statement; returns {userID: new balance}
+        if not credits:
+            return {}
+
+        time = int(time)
+        balances = await self._apply_passive_income(
+            sorted(credits.items()), time - time % self.income_bucket, time
+        )
+        for userID, balance in balances.items():
+            self.cache.patch(userID, balance=balance)
+            self.ranks.set_wallet(userID, balance)
+        self._wrote(*balances)
+        return balances
+
+    async def _apply_passive_income(self, credits, bucket, time):
+        rows = await self.fetchall(
+            "passive_income", [c[0] for c in credits], [c[1] for c in credits], bucket, time
+        )
+        return {row[0]: row[1] for row in rows}
+
+    async def transfer(
+        self,
+        fromID,
+        toID,
+        amount,
+        reasons,
+        side_effects=None,
+        time=0,
+        bank=None,
+        check_funds=True
+    ):
+        """Move amount from fromID to toID in one locked statement.
+
+        reasons is (debit reason, credit reason). side_effects maps either
+        user to column changes applied in the same statement: counters in
+        COUNTER_COLUMNS are added to, LastStealTime is set. With bank set
+        the money comes out of fromID's account at that bank, which writes
+        no ledger row for them. Returns (from balance, to balance), or a
+        DatabaseError when fromID can't cover the amount.
+        """
+        if fromID == toID:
+            return DatabaseError("You can't transfer to yourself.")
+
+        side_effects = side_effects or {}
+        for userID, changes in side_effects.items():
+            unknown = set(changes) - set(COUNTER_COLUMNS) - {"LastStealTime"}
+            if userID not in (fromID, toID) or unknown:
+                raise ValueError(f"Unsupported side effect for {userID}: {changes}")
+
+        if bank is None:
+            moves = {fromID: (-amount, reasons[0]), toID: (amount, reasons[1])}
+        else:
+            moves = {fromID: (0, None), toID: (amount, reasons[1])}
+
+        users = sorted(moves)
+        effects = [side_effects.get(u, {}) for u in users]
+        participants = [
+            (
+                u,
+                moves[u][0],
+                moves[u][1],
+                effects[i].get("Wantedness", 0),
+                effects[i].get("Alertness", 0),
+                float(effects[i].get("LastStealTime", 0))
+            )
+            for i, u in enumerate(users)
+        ]
+        time = int(time)
+        rows = await self._apply_transfer(
+            participants, fromID, amount, check_funds, time, bank, self.ledger is None
+        )
+
+        if not rows[0]["ok"]:
+            return DatabaseError("Insufficient funds for this transaction.")
+
+        balances = {}
+        for row in rows:
+            balances[row["userid"]] = row["balance"]
+            self.cache.patch(
+                row["userid"],
+                balance=row["balance"],
+                wantedness=row["wantedness"],
+                alertness=row["alertness"],
+                laststealtime=row["laststealtime"],
+                wantednesstime=row["wantednesstime"],
+                alertnesstime=row["alertnesstime"]
+            )
+            self.ranks.set_wallet(row["userid"], row["balance"])
+        if bank is not None:
+            self.ranks.set_account(fromID, bank, rows[0]["accountbalance"])
+        self._wrote(*balances)
+
+        await self._log([
+            (u, delta, balances[u], time, reason)
+            for u, delta, reason, *_ in participants
+            if reason is not None
+        ])
+
+        if bank is not None:
+            return rows[0]["accountbalance"], balances[toID]
+        return balances[fromID], balances[toID]
+
+    async def _apply_transfer(self, participants, fromID, amount, check_funds, time, bank, ledger):
+        # participants: (UserID, Delta, Reason, Wantedness, Alertness,
+        # LastStealTime) sorted by UserID, one row per user
+        args = [list(column) for column in zip(*participants)]
+        args += [fromID, amount, check_funds, time]
+
+        if bank is None:
+            return await self.fetchall("transfer", *args, ledger)
+        return await self.fetchall("transfer_from_bank", *args, bank, ledger)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        # one pooled connection for the whole block; lock rows with
+        # SELECT ... FOR UPDATE inside it, commit on exit
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                yield conn
 
     async def bank_deposit(
         self,
@@ -97,130 +992,110 @@ class Database:
         bank,
         isRob
     ):
-        current_bal = await self.fetchone(
-            "SELECT Balance FROM econ WHERE UserID = $1",
-            userID
-        )
-
-        current_bal = current_bal[0] if current_bal else 0
-
-        current_bank_balance = await self.fetchone(
-            """
-            SELECT
-                ba.Balance,
-                ba.LastDepositTime,
-                b.MinimumDepositTime,
-                b.MinimumDeposit
-            FROM banks b
-            LEFT JOIN bankaccounts ba
-                ON b.ShortName = ba.BankType
-                AND ba.UserID = $1
-            WHERE b.ShortName = $2
-            """,
-            userID,
-            bank
-        )
-        #help 
-        print(f"Bank {bank} has received request")
-
-        if current_bank_balance is None:
-            raise DatabaseError("Bank not found.")
-
-        balance = (
-            current_bank_balance[0]
-            if current_bank_balance[0] is not None
-            else 0
-        )
-
-        last_deposit = (
-            current_bank_balance[1]
-            if current_bank_balance[1] is not None
-            else 0
+        log_msg = (
+            f"Deposited to bank {bank}"
+            if deposit > 0
+            else f"Withdrew from bank {bank}"
         )
 
-        min_cooldown = (
-            current_bank_balance[2]
-            if current_bank_balance[2] is not None
-            else 0
+        currenttime = int(currenttime)
+        result = await self._apply_bank_move(
+            userID,
+            bank,
+            deposit,
+            currenttime,
+            bool(isRob),
+            log_msg,
+            self.ledger is None
         )
+        status = result["status"]
 
-        min_deposit = (
-            current_bank_balance[3]
-            if current_bank_balance[3] is not None
-            else 0
-        )
+        if status == "bank":
+            raise DatabaseError("Bank not found.")
 
-        if (
-            deposit < 0
-            and currenttime - last_deposit < min_cooldown
-            and isRob == 0
-        ):
+        if status == "cooldown":
             return DatabaseError(
                 "Withdrawal cooldown active. "
                 "Please wait before making another withdrawal."
             )
 
-        if min_deposit > deposit > 0:
+        if status == "minimum":
             return DatabaseError(
-                f"Deposit amount is below the minimum allowed (${min_deposit})."
+                f"Deposit amount is below the minimum allowed (${result['minimumdeposit']})."
             )
 
-        if (
-            balance + deposit < 0
-            or (current_bal < deposit and isRob == 0)
-        ):
+        if status == "funds":
             return DatabaseError(
                 "Insufficient funds for this transaction."
             )
 
-        log_msg = (
-            f"Deposited to bank {bank}"
-            if deposit > 0
-            else f"Withdrew from bank {bank}"
+        self.ranks.set_account(userID, bank, result["account"])
+        if result["wallet"] is not None:
+            self.cache.patch(userID, balance=result["wallet"])
+            self.ranks.set_wallet(userID, result["wallet"])
+            self._wrote(userID)
+            await self._log([(userID, -deposit, result["wallet"], currenttime, log_msg)])
+        return result["wallet"], result["account"]
+
+    async def _apply_bank_move(self, userID, bank, deposit, time, isRob, reason, ledger):
+        # locks, checks and both moves run server-side as one statement
+        return await self.fetchone(
+            "bank_move", userID, bank, deposit, time, isRob, reason, ledger
         )
 
-        if isRob == 0:
-            await self.change_balance(
-                userID,
-                -deposit,
-                log_msg,
-                currenttime
-            )
+    async def asset_freeze(self, userID, time):
+        # bank accounts are seized and the wallet halved, which the ledger records
+        time = int(time)
+        async with self.transaction() as conn:
+            before = await conn.fetchval(QUERIES["lock_econ"], userID)
+            await conn.execute(QUERIES["heist_freeze_accounts"], userID)
+            balance = await conn.fetchval(QUERIES["heist_freeze_wallet"], userID)
+            row = None if balance is None else (userID, balance - before, balance, time, "Asset Freeze")
+            if row is not None and self.ledger is None:
+                await conn.execute(QUERIES["ledger_insert"], *row)
+        self.cache.patch(userID, balance=balance)
+        self.ranks.drop_accounts(userID)
+        if balance is not None:
+            self.ranks.set_wallet(userID, balance)
+        self._wrote(userID)
+        if row is not None:
+            await self._log([row])
+        return balance
 
-        if deposit < 0:
-            print("Withdrawal")
-
-            await self.write(
-                """
-                UPDATE bankaccounts
-                SET Balance = Balance + $1
-                WHERE UserID = $2
-                  AND BankType = $3
-                """,
-                deposit,
-                userID,
-                bank
-            )
+    async def add_wantedness(self, userID, amount, time):
+        # on top of what hasn't worn off yet by time
+        return await self._update_wantedness("econ_add_wantedness", userID, amount, time)
 
-        else:
-            print("Deposit")
-
-            await self.write(
-                """
-                INSERT INTO bankaccounts
-                    (UserID, BankType, Balance, LastDepositTime)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT (UserID, BankType)
-                DO UPDATE SET
-                    Balance = bankaccounts.Balance + EXCLUDED.Balance,
-                    LastDepositTime = EXCLUDED.LastDepositTime
-                """,
-                userID,
-                bank,
-                deposit,
-                currenttime
-            )
+    async def set_wantedness(self, userID, value, time):
+        return await self._update_wantedness("econ_set_wantedness", userID, value, time)
+
+    async def _update_wantedness(self, query, userID, value, time):
+        row = await self.fetchone(query, userID, value, int(time))
+        if row is None:
+            return None
+        self.cache.patch(userID, wantedness=row["wantedness"], wantednesstime=row["wantednesstime"])
+        self._wrote(userID)
+        return row["wantedness"]
+
+    async def set_last_vote_time(self, userID, time):
+        # one column of one row and no balance: patch it rather than going
+        # through execute(), which would drop every cached row and the ranks
+        time = int(time)
+        await self._run("execute", "set_last_vote_time", (time, userID))
+        self.cache.patch(userID, lastvotetime=time)
+        self._wrote(userID)
 
     async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        # the ledger goes out before the pool it's written through
+        if self.ledger is not None:
+            await self.ledger.close()
+        if self.replica_pool is not None:
+            self._replica_watcher.cancel()
+            self.replica_monitor.stop()
+            await self.replica_pool.close()
+        self.monitor.stop()
         await self.pool.close()
 
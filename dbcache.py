@@ -0,0 +1,64 @@
+import os
+from collections import OrderedDict
+
+
+class EconCache:
+    """LRU of econ rows keyed by UserID.
+
+    Rows are plain dicts with the lowercase column names asyncpg returns.
+    Database fills it on read and patches it from the RETURNING values of
+    its own writes, so reads after a write never need to go back to Postgres.
+    """
+
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size or int(os.getenv("ECON_CACHE_SIZE", "5000"))
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # bumped by every invalidate(), so a read that raced one can tell
+        self.generation = 0
+
+    def get(self, userID):
+        row = self.rows.get(userID)
+        if row is None:
+            self.misses += 1
+            return None
+        self.rows.move_to_end(userID)
+        self.hits += 1
+        return row
+
+    def put(self, userID, row):
+        self.rows[userID] = dict(row)
+        self.rows.move_to_end(userID)
+        while len(self.rows) > self.max_size:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+
+    def patch(self, userID, **fields):
+        # only rows we already hold are touched; a partial row would look
+        # like a full one to the next reader
+        row = self.rows.get(userID)
+        if row is not None:
+            row.update((k.lower(), v) for k, v in fields.items())
+
+    def invalidate(self, userID=None):
+        self.invalidations += 1
+        self.generation += 1
+        if userID is None:
+            self.rows.clear()
+        else:
+            self.rows.pop(userID, None)
+
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.rows),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
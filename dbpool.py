@@ -0,0 +1,129 @@
+import asyncio
+import contextlib
+import os
+import time
+from collections import deque
+
+
+def pool_bounds():
+    min_size = int(os.getenv("DB_POOL_MIN", "10"))
+    max_size = int(os.getenv("DB_POOL_MAX", str(max(min_size, 10))))
+    return min_size, max(min_size, max_size)
+
+
+class PoolMonitor:
+    """Wraps pool.acquire() to time checkouts and cap concurrent use.
+
+    The cap starts at the pool's max size. With auto-tune on it starts at
+    the min size instead and is moved between min and max by tune(): up
+    while acquires keep waiting, down while connections sit idle. asyncpg
+    only opens connections on demand and closes idle ones after
+    max_inactive_connection_lifetime, so the cap is what sizes the pool.
+    """
+
+    def __init__(self, pool, autotune: bool = False, window: int = 1000):
+        self.pool = pool
+        self.autotune = autotune
+        self.limit = pool.get_min_size() if autotune else pool.get_max_size()
+        self.in_use = 0
+        self.waiting = 0
+        self.peak_in_use = 0
+        self.acquires = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_checkout = 0.0
+        self.max_checkout = 0.0
+        self.waits = deque(maxlen=window)
+        self._window_waits = []
+        self._slot = asyncio.Condition()
+        self._tuner = None
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        requested = time.perf_counter()
+        self.waiting += 1
+        try:
+            async with self._slot:
+                await self._slot.wait_for(lambda: self.in_use < self.limit)
+                self.in_use += 1
+            try:
+                conn = await self.pool.acquire(timeout=timeout)
+            except BaseException:
+                await self._release_slot()
+                raise
+        finally:
+            self.waiting -= 1
+
+        acquired = time.perf_counter()
+        wait = acquired - requested
+        self.acquires += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.waits.append(wait)
+        self._window_waits.append(wait)
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+        try:
+            yield conn
+        finally:
+            checkout = time.perf_counter() - acquired
+            self.total_checkout += checkout
+            self.max_checkout = max(self.max_checkout, checkout)
+            try:
+                await self.pool.release(conn)
+            finally:
+                await self._release_slot()
+
+    async def _release_slot(self):
+        async with self._slot:
+            self.in_use -= 1
+            self._slot.notify()
+
+    def snapshot(self):
+        waits = sorted(self.waits)
+        p95 = waits[int(len(waits) * 0.95) - 1] if waits else 0.0
+        return {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "limit": self.limit,
+            "autotune": self.autotune,
+            "acquires": self.acquires,
+            "wait_avg_ms": round(self.total_wait * 1000 / self.acquires, 3) if self.acquires else 0.0,
+            "wait_p95_ms": round(p95 * 1000, 3),
+            "wait_max_ms": round(self.max_wait * 1000, 3),
+            "checkout_avg_ms": round(self.total_checkout * 1000 / self.acquires, 3) if self.acquires else 0.0,
+            "checkout_max_ms": round(self.max_checkout * 1000, 3),
+        }
+
+    async def tune(self, grow_after: float = 0.01):
+        # one tuning step over the acquires seen since the last call
+        waits, self._window_waits = self._window_waits, []
+        peak, self.peak_in_use = self.peak_in_use, self.in_use
+        slow = sum(1 for w in waits if w > grow_after)
+
+        async with self._slot:
+            if slow and slow >= len(waits) // 10 and self.limit < self.pool.get_max_size():
+                self.limit += 1
+                self._slot.notify_all()
+            elif not slow and peak < self.limit - 1 and self.limit > self.pool.get_min_size():
+                self.limit -= 1
+
+    def start(self, interval: float = 10.0):
+        if not self.autotune or self._tuner is not None:
+            return
+
+        async def tuner():
+            while True:
+                await asyncio.sleep(interval)
+                await self.tune()
+
+        self._tuner = asyncio.create_task(tuner())
+
+    def stop(self):
+        if self._tuner is not None:
+            self._tuner.cancel()
+            self._tuner = None
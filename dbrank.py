@@ -0,0 +1,174 @@
+from sortedcontainers import SortedList
+
+# "liquid" ranks wallets alone, "networth" adds every bank account
+BOARDS = ("liquid", "networth")
+
+
+class RankIndex:
+    """Every econ user ranked by wallet and by net worth, in memory.
+
+    Database loads it with one query and updates it from the RETURNING
+    values of its own writes, like EconCache, so leaderboards, a user's
+    rank and the users around them never need a query of their own. Each
+    board is a SortedList of (-value, UserID): rank lookups are O(log n),
+    and equal values are ordered by UserID. Ranks start at 1.
+    """
+
+    def __init__(self):
+        self.wallets = {}
+        # {UserID: {BankType: settled balance}}
+        self.accounts = {}
+        self.boards = {board: SortedList() for board in BOARDS}
+        self._keys = {board: {} for board in BOARDS}
+        self.loaded = False
+        # updates made while a load query runs; replayed onto its rows
+        self._pending = None
+        self.loads = 0
+        self.updates = 0
+        # bumped by every clear(), so a load that raced one can tell
+        self.generation = 0
+
+    def start_load(self):
+        self._pending = []
+
+    @staticmethod
+    def _parse(rows):
+        # rows: (UserID, wallet, BankType, account balance), one per bank
+        # account and a NULL BankType for users without any
+        wallets, accounts = {}, {}
+        for userID, wallet, bank, balance in rows:
+            userID = int(userID)
+            wallets[userID] = wallet
+            if bank is not None:
+                accounts.setdefault(userID, {})[bank] = balance
+        return wallets, accounts
+
+    def load(self, rows, userIDs=None):
+        # everyone, or with userIDs just them (any without a row are gone)
+        pending, self._pending = self._pending or [], None
+        if userIDs is None:
+            self.wallets, self.accounts = self._parse(rows)
+            for board in BOARDS:
+                keys = {userID: (-self._value(board, userID), userID) for userID in self.wallets}
+                self._keys[board] = keys
+                self.boards[board] = SortedList(keys.values())
+            self.loaded = True
+            self.loads += 1
+        else:
+            wallets, accounts = self._parse(rows)
+            for userID in map(int, userIDs):
+                if userID not in wallets:
+                    self.forget(userID)
+                    continue
+                self.wallets[userID] = wallets[userID]
+                self.accounts[userID] = accounts.get(userID, {})
+                self._place(userID)
+
+        for update, args in pending:
+            update(*args)
+
+    def clear(self):
+        self.wallets, self.accounts = {}, {}
+        for board in BOARDS:
+            self.boards[board] = SortedList()
+            self._keys[board] = {}
+        self.loaded = False
+        self._pending = None
+        self.generation += 1
+
+    def _defer(self, update, args):
+        # True when the update can't be applied yet: mid-load it's queued,
+        # and before any load there's nothing to keep up to date
+        if self._pending is not None:
+            self._pending.append((update, args))
+            return True
+        return not self.loaded
+
+    def set_wallet(self, userID, balance):
+        if self._defer(self.set_wallet, (userID, balance)):
+            return
+        userID = int(userID)
+        self.wallets[userID] = balance
+        self._place(userID)
+
+    def set_account(self, userID, bank, balance):
+        # balance None closes the account
+        if self._defer(self.set_account, (userID, bank, balance)):
+            return
+        userID = int(userID)
+        accounts = self.accounts.setdefault(userID, {})
+        if balance is None:
+            accounts.pop(bank, None)
+        else:
+            accounts[bank] = balance
+        if userID in self.wallets:
+            self._place(userID)
+
+    def drop_accounts(self, userID):
+        if self._defer(self.drop_accounts, (userID,)):
+            return
+        userID = int(userID)
+        self.accounts.pop(userID, None)
+        if userID in self.wallets:
+            self._place(userID)
+
+    def forget(self, userID):
+        if self._defer(self.forget, (userID,)):
+            return
+        userID = int(userID)
+        self.wallets.pop(userID, None)
+        self.accounts.pop(userID, None)
+        for board in BOARDS:
+            key = self._keys[board].pop(userID, None)
+            if key is not None:
+                self.boards[board].remove(key)
+
+    def _value(self, board, userID):
+        wallet = self.wallets[userID]
+        if board == "liquid":
+            return wallet
+        return wallet + sum(self.accounts.get(userID, {}).values())
+
+    def _place(self, userID):
+        self.updates += 1
+        for board in BOARDS:
+            key = (-self._value(board, userID), userID)
+            old = self._keys[board].get(userID)
+            if old == key:
+                continue
+            if old is not None:
+                self.boards[board].remove(old)
+            self.boards[board].add(key)
+            self._keys[board][userID] = key
+
+    def value(self, board, userID):
+        key = self._keys[board].get(int(userID))
+        return None if key is None else -key[0]
+
+    def rank(self, board, userID):
+        key = self._keys[board].get(int(userID))
+        return None if key is None else self.boards[board].index(key) + 1
+
+    def top(self, board, start=0, count=10):
+        # [(rank, UserID, value)] for ranks start + 1 .. start + count
+        ranked = self.boards[board].islice(start, start + count)
+        return [(start + i + 1, userID, -value) for i, (value, userID) in enumerate(ranked)]
+
+    def around(self, board, userID, radius=2):
+        # the user with up to radius users either side of them
+        rank = self.rank(board, userID)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return self.top(board, start, rank - start + radius)
+
+    def __len__(self):
+        return len(self.wallets)
+
+    def snapshot(self):
+        return {
+            "loaded": self.loaded,
+            "users": len(self.wallets),
+            "loads": self.loads,
+            "updates": self.updates,
+        }
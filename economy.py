@@ -1,88 +1,155 @@
 
-import asyncio
 import discord
 from discord.ext import commands
 import random
-from database import Database, DatabaseError
+from database import Database, DatabaseError, heat
 from discord.ext import commands, tasks
 from discord import app_commands
 import time
 import math
 import datetime
+import json
+import os
+import tempfile
 
-texted_lat_minute = set()
-banks = [
-    app_commands.Choice(name="Leo/Need and Co.", value="LNC"),
-    app_commands.Choice(name="MOA MOA Savings", value="MMS"),
-    app_commands.Choice(name="Rad Dogs Investemts", value="RDI"),
-    app_commands.Choice(name="Bank of the Wonderful Stage", value="BWS"),
-    app_commands.Choice(name="UnionCord at 25", value="UC25")
-]
+# coins a user earns for talking in a minute, unless the guild says otherwise
+PASSIVE_INCOME = 150
+LEADERBOARD_PAGE = 10
+BOARD_NAMES = {"liquid": "Liquid", "networth": "Net Worth"}
+GUILD_SETTINGS_FILE = "Databases/economy_guilds.json"
 
+texted_lat_minute = set()
 async def shared_bank_autocomplete(interaction: discord.Interaction, current: str):
+    # runs on every keystroke, so it reads the banks table from Database's cache
+    rows = await interaction.client.db.banks()
     return [
-    choice for choice in banks 
-    if current.lower() in choice.name.lower()
+    app_commands.Choice(name=row["bankname"], value=short) for short, row in rows.items()
+    if current.lower() in row["bankname"].lower() or current.lower() in short.lower()
     ][:25]
 
 class Economy(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db: Database = bot.db
+        # {guild id: {"enabled", "rate"}}; on_message reads income_rates,
+        # the same thing flattened to {guild id: coins per minute, 0 if off}
+        self.guild_settings = self.load_guild_settings()
+        self.income_rates = {}
+        self.apply_guild_settings()
+        # {user id: coins} earned this minute
+        self.income = {}
+        self.income_stats = {
+            "messages_seen": 0,
+            "flushes": 0,
+            "accrued_users": 0,
+            "last_flush_users": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+        }
         self.refresh.start()
         self.textcalcs.start()
-        self.sets = set()
+        self.archive.start()
+
+    def load_guild_settings(self):
+        os.makedirs("Databases", exist_ok=True)
+        if not os.path.exists(GUILD_SETTINGS_FILE):
+            return {}
+        with open(GUILD_SETTINGS_FILE, "r", encoding="utf-8") as f:
+            return {int(k): v for k, v in json.load(f).items()}
+
+    def save_guild_settings(self):
+        with open(GUILD_SETTINGS_FILE, "w", encoding="utf-8") as f:
+            json.dump({str(k): v for k, v in self.guild_settings.items()}, f, indent=4)
 
+    def apply_guild_settings(self):
+        self.income_rates = {
+            guild: settings.get("rate", PASSIVE_INCOME) if settings.get("enabled", True) else 0
+            for guild, settings in self.guild_settings.items()
+        }
 
     @tasks.loop(seconds = 60)
     async def textcalcs(self):
-        print(self.sets)
-        current_time = int(time.time())
-        for i in self.sets:
-            await self.db.change_balance(i,150,"Message Sent", current_time)
-        self.sets = set()
+        # swap before the await so messages seen during the write count
+        # towards the next minute
+        credits, self.income = self.income, {}
+        if not credits:
+            return
+        started = time.perf_counter()
+        try:
+            await self.db.add_passive_income(credits, int(time.time()))
+        except Exception as e:
+            # keep them for the next minute rather than dropping them; an
+            # exception out of here would stop the loop for good
+            for user, amount in credits.items():
+                if amount > self.income.get(user, 0):
+                    self.income[user] = amount
+            print(f"Passive income flush failed, retrying next minute: {e}")
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        stats = self.income_stats
+        stats["flushes"] += 1
+        stats["accrued_users"] += len(credits)
+        stats["last_flush_users"] = len(credits)
+        stats["last_flush_ms"] = round(elapsed, 3)
+        stats["max_flush_ms"] = max(stats["max_flush_ms"], stats["last_flush_ms"])
 
     @tasks.loop(hours=1)
     async def refresh(self):
         print("HI")
         current_time = int(time.time())
-        await self.db.write("UPDATE econ SET Wantedness = Wantedness - 1 WHERE Wantedness > 0")
-        await self.db.write("UPDATE econ SET Alertness = Alertness - 1 WHERE Alertness > 0")
-        await self.db.write("""
-            UPDATE bankaccounts
-            SET Balance = FLOOR(Balance * (banks.InterestRate))
-            FROM banks
-            WHERE bankaccounts.BankType = banks.ShortName;
-        """)
-        print(f"Refreshed Wantedness and Alertness at {datetime.datetime.fromtimestamp(current_time)}")
+        # Wantedness and Alertness wear off on their own (database.heat)
+        await self.db.write("tick_interest")
+        print(f"Ticked bank interest at {datetime.datetime.fromtimestamp(current_time)}")
+        settled = await self.db.settle_accounts()
+        if settled:
+            print(f"Settled interest on {settled} idle bank accounts")
+        mismatches = await self.db.check_ledger(current_time)
+        for mismatch in mismatches:
+            print(
+                f"Ledger mismatch for {mismatch['userid']}: balance {mismatch['balance']}, "
+                f"ledger adds up to {mismatch['expected']}"
+            )
+            for row in mismatch["rows"]:
+                print(f"    {row}")
+
 
+    @tasks.loop(hours=1)
+    async def archive(self):
+        moved = await self.db.archive_ledger(int(time.time()))
+        if moved:
+            print(f"Archived {moved} ledger rows")
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        self.sets.add(message.author.id)
-        print("recieved")
+        # runs for every message the bot can see; keep it to a few lookups
+        self.income_stats["messages_seen"] += 1
+        if message.guild is None or message.webhook_id is not None or message.author.bot:
+            return
+        rate = self.income_rates.get(message.guild.id, PASSIVE_INCOME)
+        # one credit a minute, at the best rate of the guilds they talked in
+        if rate > self.income.get(message.author.id, 0):
+            self.income[message.author.id] = rate
 
     @app_commands.command(name="ichirob", description="Rob a user of their IchiCoins")
     async def ichirob(self, interaction: discord.Interaction, target: discord.User):
         current_time = time.time()
         user = interaction.user.id
         targetID = target.id
-        row = await self.db.fetchone("SELECT LastStealTime FROM econ WHERE UserID = $1", user)
-        laststeal = row[0] if row and row[0] is not None else 0
+        robber = await self.db.econ_row(user)
+        laststeal = robber["laststealtime"] if robber else 0
         if current_time - laststeal < 60:
             await interaction.response.send_message("You can chill out on robbing people, y'know?")
             return
-        check = await self.db.fetchone("SELECT Balance FROM econ where UserID = $1", targetID)
-        check1 = await self.db.fetchone("SELECT Wantedness FROM econ where UserID = $1", user)
-        check1 = check1[0] if check1 else 0
+        check = await self.db.econ_row(targetID)
+        check1 = heat(robber["wantedness"], robber["wantednesstime"], current_time) if robber else 0
         if check == None:
             await interaction.response.send_message(content="The User does not have an open account")
             return
         if check1 >=5:
             await interaction.response.send_message(content="Oopsie! You got caught ^^")
-            await self.db.write("UPDATE econ SET Wantedness = Wantedness + 5 WHERE UserID = $1", current_time)
+            await self.db.add_wantedness(user, 5, current_time)
             return
-        stealbal = check[0]
+        stealbal = check["balance"]
         if stealbal <= 0:
             await interaction.response.send_message(content="They're broke, sadly", ephemeral=True)
             return
@@ -90,10 +157,15 @@ class Economy(commands.Cog):
         stealbal = math.floor(stealbal/25 if stealbal/25 < 100000 else 100000)
         reason1 = f"Balance stolen by {user}"
         reason2 = f"Balance stolen from {targetID}"
-        await self.db.change_balance(targetID, -stealbal, reason1, current_time)
-        await self.db.change_balance(user, stealbal, reason2, current_time)
-        await self.db.write("UPDATE econ SET LastStealTime = $1, Wantedness = Wantedness + 3 WHERE UserID = $2", current_time, user)
-        await interaction.response.send_message(content=f"Stole {stealbal} from {target.name}")
+        result = await self.db.transfer(
+            targetID, user, stealbal, (reason1, reason2),
+            side_effects={user: {"Wantedness": 3, "LastStealTime": current_time}},
+            time=current_time
+        )
+        if isinstance(result, DatabaseError):
+            await interaction.response.send_message(content=str(result), ephemeral=True)
+            return
+        await interaction.response.send_message(content=f"Stole {stealbal} from {target.name}. You now have {result[1]} coins")
 
 
 
@@ -101,15 +173,19 @@ class Economy(commands.Cog):
     @app_commands.command(name="ichiheist", description="Attempt to rob a bank account for Ichicoins")
     async def ichiheist(self, interaction: discord.Interaction, bank: str, user: discord.User):
         print(f"User {interaction.user.id} is attempting to rob {user.id}'s bank account at {bank}")
-        target = await self.db.fetchone("SELECT u.UserID, ba.Balance, u.Alertness, b.SecurityModifier FROM bankaccounts ba INNER JOIN banks b ON ba.BankType = b.ShortName INNER JOIN econ u ON ba.UserID = u.UserID WHERE u.UserID = $1 AND b.ShortName = $2", user.id, bank)
+        current_time = time.time()
+        target = await self.db.fetchone("heist_target", user.id, bank, int(current_time))
         print(target)
-        robber = await self.db.fetchone("SELECT u.Wantedness, u.LuckModifier FROM econ u WHERE u.UserID = $1", interaction.user.id)
+        robber = await self.db.econ_row(interaction.user.id)
+        robber = (
+            (heat(robber["wantedness"], robber["wantednesstime"], current_time), robber["luckmodifier"])
+            if robber else (0, 0)
+        )
         print(robber)   
         assetchance = random.randint(1, 10)
         if robber[0] >= 7 or robber[0] >= assetchance :
             await interaction.response.send_message(content=f"FREEZE! THIS IS AN ASSET FREEZE!", ephemeral=True) 
-            await self.db.write("DELETE FROM bankaccounts WHERE UserID = $1", interaction.user.id)
-            await self.db.write("UPDATE econ SET balance = FLOOR(balance/2) WHERE UserID = $1", interaction.user.id)
+            await self.db.asset_freeze(interaction.user.id, current_time)
             return
         if target is None:
             await interaction.response.send_message(content="The user does not have an account with that bank.", ephemeral=True)
@@ -131,50 +207,42 @@ class Economy(commands.Cog):
         roll = random.randint(1, 50)
         if roll <= chance:
             robamount = math.floor(target[1] * random.uniform(0.2, 0.3))
-            await self.db.bank_deposit(user.id, -robamount, int(time.time()), bank,1)
-            await self.db.change_balance(interaction.user.id, robamount, f"Bank Heist from {target[0]}", int(time.time()))
+            result = await self.db.transfer(
+                user.id, interaction.user.id, robamount, (None, f"Bank Heist from {target[0]}"),
+                side_effects={interaction.user.id: {"Wantedness": 1}, user.id: {"Alertness": 1}},
+                time=current_time, bank=bank
+            )
+            if isinstance(result, DatabaseError):
+                await interaction.response.send_message(content=str(result), ephemeral=True)
+                return
             await interaction.response.send_message(content=f"Successfully robbed {robamount} from {user.name}'s bank account at {bank}!")
-            await self.db.write("UPDATE econ SET Wantedness = Wantedness + 1 WHERE UserID = $1", interaction.user.id)
-            await self.db.write("UPDATE econ SET Alertness = Alertness + 1 WHERE UserID = $1", user.id)
         else:
             await interaction.response.send_message(content=f"Failed to rob {user.name}'s bank account at {bank}. Better luck next time!", ephemeral=True)  
-            await self.db.write("UPDATE econ SET Wantedness = 7 WHERE UserID = $1", interaction.user.id)
+            await self.db.set_wantedness(interaction.user.id, 7, current_time)
 
     @app_commands.command(name="ichiportfolio", description="Show current your current bank and investment portfolio")
     async def ichiportfolio(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        print("Hi")
         user = interaction.user.id
-        balance_row = await self.db.fetchone(
-            "SELECT Balance FROM econ WHERE UserID = $1",
-            user
+        # the replica is fine unless they just moved money themselves
+        portfolio = await self.db.portfolio(
+            user, time.time(), consistent=self.db.wrote_recently(user)
         )
-        balance = balance_row[0] if balance_row else 0
-        print(balance)
 
-        current_balance = balance
-        print(current_balance)
         embed = discord.Embed(
             title=f"{interaction.user.name}'s Balance",
-            description=f"**Current Balance:** {current_balance} coins",
+            description=(
+                f"**Current Balance:** {portfolio.wallet} coins"
+                f"\n**Net Worth:** {portfolio.net_worth} coins"
+            ),
             color=discord.Color.gold()
         )
         banklist = ""
-        sum = 0
-        for i in ["LNC", "MMS", "RDI", "BWS", "UC25"]:
-            balance = await self.db.fetchone(
-                "SELECT Balance FROM bankaccounts WHERE UserID = $1 AND BankType = $2",
-                user, i
-            )
-            balance = 0 if balance is None else balance[0]
-            strings = f"**{i}** balance: {balance}"
-            banklist = banklist + f"\n{strings}"
-            sum += balance
-        banklist = banklist + f"\nTotal Balance within Banks: {sum}"
+        for bank, balance in portfolio.banks.items():
+            banklist = banklist + f"\n**{bank}** balance: {balance}"
+        banklist = banklist + f"\nTotal Balance within Banks: {portfolio.bank_total}"
         embed.add_field(name="Current Bank Balances",value=banklist)
-        wanted = await self.db.fetchone("SELECT Wantedness FROM econ WHERE UserID = $1", interaction.user.id)
-        wanted = 0 if wanted is None else wanted[0]
-        stars = "✰Clean Record" if wanted == 0 else "★" * wanted 
+        stars = "✰Clean Record" if portfolio.wanted == 0 else "★" * portfolio.wanted
         embed.add_field(name="Wanted Level", value=stars)
         print(interaction.user.display_avatar.url)
         embed.set_thumbnail(url=interaction.user.display_avatar.url)
@@ -185,21 +253,14 @@ class Economy(commands.Cog):
         await interaction.response.defer()
         user = interaction.user.id
         current_time = int(time.time())
-        ledger = await self.db.fetchall(
-            """
-            SELECT BalanceChange, BalanceAfter, Timestamp, Reason
-            FROM balancehistory
-            WHERE Timestamp >= $1 AND UserID = $2
-            ORDER BY Timestamp DESC
-            LIMIT 100
-            """,
-            current_time - 86400, user
-        )
+        ledger = await self.db.recent_ledger(user, current_time - 86400)
         print(f"Ledger for user {user}: {ledger}")
         collapsedLedger = []
         runningTotal = 0
         currentTimestamp = 0
         i = 1
+        # passive income arrives already rolled up per hour; only rows
+        # written before the rollup existed still need folding together
         for balChange, balAft, timestamp, reason in ledger:
             if reason != "Message Sent":
                 if runningTotal != 0:
@@ -276,20 +337,45 @@ class Economy(commands.Cog):
 
         await interaction.followup.send(embed=embed)
 
-    @app_commands.command(name="ichilb", description="Displays the current Leaderboard for liquid Ichicoins")
-    async def ichilb(self, interaction: discord.Interaction):
+    async def ranking_table(self, rows):
+        # rows: [(rank, UserID, balance)] from the RankIndex
+        lb_text = "```\n"
+        lb_text += f"{'Rank':<5} {'User':<25} {'Balance':>12}\n"
+        lb_text += "-" * 45 + "\n"
+        for rank, user_id, balance in rows:
+            user = await self.bot.fetch_user(user_id)
+            if user is not None:
+                username = user.name
+            else:
+                username = "Error"
+            lb_text += f"{rank:<5} {username[:25]:<25} {balance:>12,}\n"
+        lb_text += "```"
+        return lb_text
+
+    @app_commands.command(name="ichilb", description="Displays the Ichicoins leaderboard, by wallet or by net worth")
+    @app_commands.describe(
+        board="Liquid counts wallets only, Net Worth adds bank accounts",
+        page=f"{LEADERBOARD_PAGE} users a page"
+    )
+    @app_commands.choices(board=[
+        app_commands.Choice(name=name, value=board) for board, name in BOARD_NAMES.items()
+    ])
+    async def ichilb(
+        self,
+        interaction: discord.Interaction,
+        board: app_commands.Choice[str] = None,
+        page: int = 1
+    ):
         await interaction.response.defer()
-        leaderboard = await self.db.fetchall(
-            """
-            SELECT UserID, Balance
-            FROM econ
-            ORDER BY Balance DESC
-            LIMIT 10
-            """
-        )
+        board = "liquid" if board is None else board.value
+        # served from memory; see Database.ranking
+        ranks = await self.db.ranking()
+        pages = max(1, math.ceil(len(ranks) / LEADERBOARD_PAGE))
+        page = max(1, min(page, pages))
+        leaderboard = ranks.top(board, (page - 1) * LEADERBOARD_PAGE, LEADERBOARD_PAGE)
 
         embed = discord.Embed(
-            title="Ichicoins Leaderboard",
+            title=f"Ichicoins Leaderboard ({BOARD_NAMES[board]})",
             color=discord.Color.gold()
         )
 
@@ -300,26 +386,34 @@ class Economy(commands.Cog):
                 inline=False
             )
         else:
-            lb_text = "```\n"
-            lb_text += f"{'Rank':<5} {'User':<25} {'Balance':>12}\n"
-            lb_text += "-" * 45 + "\n"
-
-            for rank, (user_id, balance) in enumerate(leaderboard, start=1):
-                print(user_id)
-                user = await self.bot.fetch_user(user_id)
-                print(user)
-                if user is not None:
-                    username = user.name
-                else:
-                    username = "Error"
-                #username = user.name if user else f"User ID {user_id}"
-                lb_text += f"{rank:<5} {username[:25]:<25} {balance:>12,}\n"
-
-            lb_text += "```"
-
             embed.add_field(
                 name="Leaderboard",
-                value=lb_text[:1024],
+                value=(await self.ranking_table(leaderboard))[:1024],
+                inline=False
+            )
+        embed.set_footer(text=f"Page {page}/{pages}")
+
+        await interaction.followup.send(embed=embed)
+
+    @app_commands.command(name="ichirank", description="Shows where you (or someone else) rank on both leaderboards")
+    @app_commands.describe(user="Whose rank to show; yours if left out")
+    async def ichirank(self, interaction: discord.Interaction, user: discord.User = None):
+        await interaction.response.defer()
+        user = user or interaction.user
+        ranks = await self.db.ranking()
+
+        embed = discord.Embed(
+            title=f"{user.name}'s Rank",
+            color=discord.Color.gold()
+        )
+        for board, name in BOARD_NAMES.items():
+            rank = ranks.rank(board, user.id)
+            if rank is None:
+                embed.add_field(name=name, value="No open account", inline=False)
+                continue
+            embed.add_field(
+                name=f"{name}: #{rank:,} of {len(ranks):,} ({ranks.value(board, user.id):,} coins)",
+                value=(await self.ranking_table(ranks.around(board, user.id)))[:1024],
                 inline=False
             )
 
@@ -334,12 +428,13 @@ class Economy(commands.Cog):
         try:
             result = await self.db.bank_deposit(userID=user, deposit=amount, currenttime=current_time, bank=bank, isRob=0)
         except DatabaseError as e:
-            await interaction.response.send_message(str(e))
+            await interaction.response.send_message(str(e), ephemeral=True)
+            return
         if isinstance(result, DatabaseError):
             await interaction.response.send_message(str(result), ephemeral=True)
             return
         else:
-            await interaction.response.send_message(f"Successfully deposited {amount} to {bank}.", ephemeral=True)
+            await interaction.response.send_message(f"Successfully deposited {amount} to {bank}. Bank balance: {result[1]}.", ephemeral=True)
 
     @app_commands.autocomplete(bank = shared_bank_autocomplete)
     @app_commands.command(name="ichiwithdraw", description="Withdraws a select number of Ichicoins from a bank of your choosing")
@@ -347,11 +442,15 @@ class Economy(commands.Cog):
         amount = -amount
         current_time = int(time.time())
         user = interaction.user.id
-        result = await self.db.bank_deposit(userID=user, deposit=amount, currenttime=current_time, bank=bank, isRob=0)
+        try:
+            result = await self.db.bank_deposit(userID=user, deposit=amount, currenttime=current_time, bank=bank, isRob=0)
+        except DatabaseError as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
+            return
         if isinstance(result, DatabaseError):
             await interaction.response.send_message(str(result), ephemeral=True)
         else:
-            await interaction.response.send_message(f"Successfully deposited {amount} to {bank}.", ephemeral=True)
+            await interaction.response.send_message(f"Successfully withdrew {-amount} from {bank}. Bank balance: {result[1]}.", ephemeral=True)
 
     @app_commands.command(name="ichitransfer", description="Transfers a select number of Ichicoins to a user of your choosing")
     async def ichitransfer(self, interaction: discord.Interaction, user: discord.User, amount: int):
@@ -359,17 +458,15 @@ class Economy(commands.Cog):
             await interaction.response.send_message("Transfer amount must be greater than zero.", ephemeral=True)
             return
         current_time = int(time.time())
-        current_bal = await self.db.fetchone("SELECT Balance FROM econ WHERE UserID = $1", interaction.user.id)
-        current_bal = current_bal[0] if current_bal else 0
-        if current_bal < amount:
-            await interaction.response.send_message("Insufficient funds for this transfer.", ephemeral=True)
-            return
-        result = await self.db.change_balance(userID=interaction.user.id, value=-amount, reason=f"Transfer to {user.name}", time=current_time)
+        result = await self.db.transfer(
+            interaction.user.id, user.id, amount,
+            (f"Transfer to {user.name}", f"Transfer from {interaction.user.name}"),
+            time=current_time
+        )
         if isinstance(result, DatabaseError):
             await interaction.response.send_message(str(result), ephemeral=True)
-        else:
-            await self.db.change_balance(userID=user.id, value=amount, reason=f"Transfer from {interaction.user.name}", time=current_time)
-            await interaction.response.send_message(f"Successfully transferred {amount} to {user.name}.", ephemeral=True)
+            return
+        await interaction.response.send_message(f"Successfully transferred {amount} to {user.name}. Your new balance is {result[0]}.", ephemeral=True)
 
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="ichiinject", description="Injects money to an account of your choosing. Admins only.")
@@ -379,8 +476,8 @@ class Economy(commands.Cog):
             return
 
         current_time = int(time.time())
-        await self.db.change_balance(userID=user.id, value=amount, reason="Admin Injection", time=current_time)
-        await interaction.response.send_message(f"Successfully injected {amount} to {user.name}'s account.", ephemeral=True)
+        new_balance = await self.db.change_balance(userID=user.id, value=amount, reason="Admin Injection", time=current_time)
+        await interaction.response.send_message(f"Successfully injected {amount} to {user.name}'s account. Their new balance is {new_balance}.", ephemeral=True)
 
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="ichiforceeconomytick", description="Forces an economy tick. Admins only.")
@@ -390,17 +487,104 @@ class Economy(commands.Cog):
             await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
             return
         print("Forcing economy tick...")
-        await self.db.write("UPDATE econ SET Wantedness = Wantedness - 1 WHERE Wantedness > 0")
-        await self.db.write("UPDATE econ SET Alertness = Alertness - 1 WHERE Alertness > 0")
-        await self.db.write("""
-            UPDATE bankaccounts
-            SET Balance = FLOOR(Balance * (banks.InterestRate))
-            FROM banks
-            WHERE bankaccounts.BankType = banks.ShortName;
-        """)
+        await self.db.write("tick_interest")
 
         print(f"Forced economy tick at {datetime.datetime.fromtimestamp(int(time.time()))}")
         await interaction.response.send_message("Economy tick forced successfully.", ephemeral=True)
 
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.guild_only()
+    @app_commands.command(name="ichiincome", description="Shows or changes passive income for this server. Admins only.")
+    @app_commands.describe(
+        enabled="Whether talking here earns Ichicoins",
+        rate="Ichicoins earned per minute of talking"
+    )
+    async def ichiincome(
+        self,
+        interaction: discord.Interaction,
+        enabled: bool = None,
+        rate: app_commands.Range[int, 0, 100000] = None
+    ):
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
+            return
+
+        settings = dict(self.guild_settings.get(
+            interaction.guild.id, {"enabled": True, "rate": PASSIVE_INCOME}
+        ))
+        if enabled is not None:
+            settings["enabled"] = enabled
+        if rate is not None:
+            settings["rate"] = rate
+        if enabled is not None or rate is not None:
+            self.guild_settings[interaction.guild.id] = settings
+            self.save_guild_settings()
+            self.apply_guild_settings()
+
+        report = "```\n"
+        report += f"enabled: {settings['enabled']}\nrate: {settings['rate']} per minute\n"
+        report += f"pending: {len(self.income)} users this minute\n"
+        report += "\n".join(f"{k}: {v}" for k, v in self.income_stats.items())
+        report += "\n```"
+        await interaction.response.send_message(report, ephemeral=True)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="ichipartitions", description="Shows the size of each ledger partition. Admins only.")
+    async def ichipartitions(self, interaction: discord.Interaction):
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
+            return
+
+        partitions = await self.db.ledger_partitions()
+        report = "```\n"
+        report += f"{'Partition':<36} {'Rows':>10} {'Size':>10}\n"
+        report += "-" * 58 + "\n"
+        for partition in partitions:
+            rows = f"{partition['rows']:,}" if partition["rows"] is not None else "?"
+            size = f"{partition['bytes'] / 1024:,.0f} KiB" if partition["bytes"] is not None else "?"
+            report += f"{partition['name'][:36]:<36} {rows:>10} {size:>10}\n"
+        report = report[:1900] + "```"
+        await interaction.response.send_message(report, ephemeral=True)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.guild_only()
+    @app_commands.command(name="ichiexport", description="Exports the ledger as a gzipped file. Admins only.")
+    @app_commands.describe(user="Only this user's history; everyone's if left out")
+    @app_commands.choices(format=[
+        app_commands.Choice(name="CSV", value="csv"),
+        app_commands.Choice(name="NDJSON", value="ndjson"),
+    ])
+    async def ichiexport(
+        self,
+        interaction: discord.Interaction,
+        user: discord.User = None,
+        format: app_commands.Choice[str] = None
+    ):
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message("You do not have permission to use this command.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        fmt = "csv" if format is None else format.value
+        name = f"ledger-{'all' if user is None else user.id}-{int(time.time())}.{fmt}.gz"
+        # spooled to disk, not memory; a whole server's history can be big
+        with tempfile.TemporaryFile() as export:
+            count = await self.db.export_ledger(export, None if user is None else user.id, fmt)
+            size = export.tell()
+            limit = interaction.guild.filesize_limit if interaction.guild else 8 * 1024 * 1024
+            if size > limit:
+                await interaction.followup.send(
+                    f"The export is {size / 1024 / 1024:.1f} MiB, over this server's "
+                    f"{limit / 1024 / 1024:.0f} MiB upload limit. Try a single user.",
+                    ephemeral=True
+                )
+                return
+            export.seek(0)
+            await interaction.followup.send(
+                f"{count:,} ledger rows.",
+                file=discord.File(export, filename=name),
+                ephemeral=True
+            )
+
 async def setup(bot):
     await bot.add_cog(Economy(bot))
\ No newline at end of file
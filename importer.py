@@ -0,0 +1,311 @@
+"""Bulk import of a SQLite economy file (the bundled economy.db) into Postgres.
+
+Migrates the target first, then streams every table through binary COPY
+into a temporary staging table and upserts from there, so re-running it
+updates rows instead of duplicating them. Tables load in parallel, each on
+its own connection, after any table they reference:
+
+    python importer.py economy.db --dsn postgresql://...
+
+Tables missing from the SQLite file are skipped.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import time
+
+import asyncpg
+from dotenv import load_dotenv
+
+from database import Database
+from migrations import migrate
+from sqlitedb import settle_interest
+
+load_dotenv()
+
+
+def _bigint(value):
+    # SQLite keeps Discord ids as TEXT; empty strings are as good as NULL
+    return None if value is None or value == "" else int(value)
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _columns(*names, convert=_bigint):
+    # same name on both sides
+    return [(name, name, convert) for name in names]
+
+
+# table: key (upserted on; None replaces the whole table), [(source column,
+# target column, converter)], tables it must load after, and optionally the
+# SQLite tables or views to read it from (first one present), target
+# columns set from SQL instead, and SQL to run once it's in
+TABLES = {
+    "banks": {
+        "key": ("ShortName",),
+        "columns": [
+            *_columns("BankName", "ShortName", convert=_text),
+            *_columns("InterestRate", "WithdrawalFee", convert=_float),
+            *_columns("MinimumDeposit", "SecurityModifier", "MinimumDepositTime"),
+            *_columns("Emoji", "Description", "Colour", "Thumbnail", convert=_text),
+        ],
+        "after": (),
+    },
+    "econ": {
+        "key": ("UserID",),
+        "columns": [
+            *_columns("UserID", "Balance", "LastVoteTime", "LastTextTime"),
+            ("LastStealTime", "LastStealTime", _float),
+            *_columns("BankBalance", "InJail", "Alertness", "Wantedness"),
+            # renamed in Postgres
+            ("Luck", "LuckModifier", _bigint),
+        ],
+        "after": (),
+        # heat starts wearing off from the import
+        "set": {
+            "WantednessTime": "EXTRACT(EPOCH FROM now())::bigint",
+            "AlertnessTime": "EXTRACT(EPOCH FROM now())::bigint",
+        },
+    },
+    "bankaccounts": {
+        "key": ("UserID", "BankType"),
+        "columns": [
+            *_columns("UserID", "Balance"),
+            ("BankType", "BankType", _text),
+            *_columns("LastDepositTime", "Gain", "Loss"),
+        ],
+        "after": ("banks",),
+        # balances with the interest owed so far, which start accruing
+        # again from the target's own clock
+        "source": ("bankaccounts_live", "bankaccounts"),
+        "set": {"SettledTick": "(SELECT Tick FROM interestclock WHERE ID = 1)"},
+    },
+    "balancehistory": {
+        "key": ("HistoryID",),
+        "columns": [
+            *_columns("HistoryID", "UserID", "BalanceChange", "BalanceAfter", "Timestamp"),
+            ("Reason", "Reason", _text),
+        ],
+        "after": (),
+        # new rows must number on from the imported ones
+        "finally": """
+            SELECT setval(
+                pg_get_serial_sequence('balancehistory', 'historyid'),
+                GREATEST((SELECT MAX(HistoryID) FROM balancehistory), 1)
+            )
+        """,
+    },
+    "passiveincome": {
+        "key": ("UserID", "Bucket"),
+        "columns": _columns(
+            "UserID", "Bucket", "Amount", "Credits", "BalanceAfter", "Timestamp"
+        ),
+        "after": (),
+    },
+    "songdata": {
+        "key": ("SongID",),
+        "columns": [
+            ("songid", "SongID", _bigint),
+            *[(name.lower(), name, _text) for name in ("PageName", "Name", "Singers", "Producers")],
+            ("duration", "Duration", _bigint),
+            ("units", "Units", _text),
+            ("bpm", "BPM", _text),
+            ("game duration", "GameDuration", _bigint),
+            ("release date", "ReleaseDate", _text),
+            *[(name.upper(), name, _bigint) for name in ("Easy", "Normal", "Hard", "Expert", "Master")],
+            ("APPEND", "Append", _text),
+            *[(name.upper(), name, _bigint) for name in ("NEasy", "NNormal", "NHard", "NExpert", "NMaster")],
+            ("NAPPEND", "NAppend", _text),
+            ("hash", "Hash", _text),
+        ],
+        "after": (),
+    },
+    "availablecommissions": {
+        "key": None,
+        "columns": [
+            ("UserID", "UserID", _bigint),
+            *_columns("ClearCondition", "UnitReq", "SongReq", "LevReq", convert=_text),
+            *_columns("DiffReq", "Reward"),
+        ],
+        "after": (),
+    },
+}
+
+
+class Progress:
+    """Rows copied so far per table, printed every second while loading."""
+
+    def __init__(self, totals):
+        self.totals = totals
+        self.copied = dict.fromkeys(totals, 0)
+        self.started = time.perf_counter()
+
+    def line(self):
+        elapsed = time.perf_counter() - self.started
+        done = sum(self.copied.values())
+        tables = ", ".join(
+            f"{name} {self.copied[name]}/{total}" for name, total in self.totals.items()
+        )
+        return f"{done}/{sum(self.totals.values())} rows, {done / elapsed:,.0f} rows/s ({tables})"
+
+    async def report(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            print(self.line())
+
+
+def _open(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    # bankaccounts_live settles interest through it
+    conn.create_function("settle_interest", 3, settle_interest, deterministic=True)
+    return conn
+
+
+def _source_tables(path):
+    # {table: (what to read it from, rows)}
+    conn = _open(path)
+    try:
+        present = {
+            row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")
+        }
+        sources = {}
+        for name, spec in TABLES.items():
+            source = next((s for s in spec.get("source", (name,)) if s in present), None)
+            if source is not None:
+                sources[name] = (source, conn.execute(f'SELECT COUNT(*) FROM "{source}"').fetchone()[0])
+        return sources
+    finally:
+        conn.close()
+
+
+async def _read(path, name, source, spec, chunk_rows, progress):
+    # SQLite reads run on a worker thread, chunk_rows at a time
+    loop = asyncio.get_running_loop()
+    conn = await loop.run_in_executor(None, _open, path)
+    try:
+        select = ", ".join(f'"{column}"' for column, _, _ in spec["columns"])
+        cursor = await loop.run_in_executor(None, conn.execute, f'SELECT {select} FROM "{source}"')
+        converters = [convert for _, _, convert in spec["columns"]]
+        while True:
+            rows = await loop.run_in_executor(None, cursor.fetchmany, chunk_rows)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(convert(value) for convert, value in zip(converters, row))
+            progress.copied[name] += len(rows)
+    finally:
+        await loop.run_in_executor(None, conn.close)
+
+
+async def load_table(pool, path, name, source, spec, chunk_rows, progress, loaded):
+    for dependency in spec["after"]:
+        if dependency in loaded:
+            await loaded[dependency]
+
+    started = time.perf_counter()
+    targets = [target for _, target, _ in spec["columns"]]
+    stage = f"import_{name}"
+    extra = spec.get("set", {})
+    columns = ", ".join([*targets, *extra])
+    select = ", ".join([*targets, *extra.values()])
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                f"CREATE TEMP TABLE {stage} (LIKE {name} INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+            await conn.copy_records_to_table(
+                stage,
+                records=_read(path, name, source, spec, chunk_rows, progress),
+                columns=[target.lower() for target in targets]
+            )
+
+            if spec["key"] is None:
+                # nothing to match rows on, so a re-run replaces the table
+                await conn.execute(f"DELETE FROM {name}")
+                status = await conn.execute(
+                    f"INSERT INTO {name} ({columns}) SELECT {select} FROM {stage}"
+                )
+            else:
+                updates = ", ".join(
+                    f"{target} = EXCLUDED.{target}"
+                    for target in [*targets, *extra] if target not in spec["key"]
+                )
+                status = await conn.execute(
+                    f"INSERT INTO {name} ({columns}) SELECT {select} FROM {stage} "
+                    f"ON CONFLICT ({', '.join(spec['key'])}) DO UPDATE SET {updates}"
+                )
+            if spec.get("finally"):
+                await conn.execute(spec["finally"])
+
+    elapsed = time.perf_counter() - started
+    rows = progress.copied[name]
+    print(
+        f"{name}: {rows} rows in {elapsed:.2f}s "
+        f"({rows / elapsed if elapsed else 0:,.0f} rows/s, {status})"
+    )
+    return rows
+
+
+async def run_import(path, dsn, ssl, jobs, chunk_rows, only=None):
+    sources = _source_tables(path)
+    if only:
+        sources = {name: source for name, source in sources.items() if name in only}
+    totals = {name: rows for name, (_, rows) in sources.items()}
+    for name in TABLES:
+        if name not in totals and (not only or name in only):
+            print(f"{name}: not in {path}, skipped")
+
+    pool = await asyncpg.create_pool(
+        dsn, ssl=ssl, statement_cache_size=0, min_size=1, max_size=jobs
+    )
+    db = Database(pool)
+    try:
+        await migrate(db)
+
+        progress = Progress(totals)
+        reporter = asyncio.create_task(progress.report())
+        loaded = {}
+        for name in totals:
+            loaded[name] = asyncio.create_task(load_table(
+                pool, path, name, sources[name][0], TABLES[name], chunk_rows, progress, loaded
+            ))
+        try:
+            await asyncio.gather(*loaded.values())
+        finally:
+            reporter.cancel()
+        print(f"Done: {progress.line()}")
+    finally:
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a SQLite economy file into Postgres")
+    parser.add_argument("source", nargs="?", default="economy.db")
+    parser.add_argument("--dsn", default=os.getenv("POSTGRESQL") or os.getenv("DATABASE_URL"))
+    parser.add_argument("--ssl", default="prefer", help="asyncpg ssl mode (disable/prefer/require)")
+    parser.add_argument("--jobs", type=int, default=4, help="tables loaded at once")
+    parser.add_argument("--chunk", type=int, default=5000, help="rows read from SQLite at a time")
+    parser.add_argument("--tables", help=f"comma separated subset of {', '.join(TABLES)}")
+
+    args = parser.parse_args()
+    if not args.dsn or args.dsn.startswith("sqlite:"):
+        parser.error("no Postgres DSN given and POSTGRESQL/DATABASE_URL is not set to one")
+    if not os.path.exists(args.source):
+        parser.error(f"{args.source} does not exist")
+    only = set(args.tables.split(",")) if args.tables else None
+    if only and only - set(TABLES):
+        parser.error(f"unknown tables: {', '.join(sorted(only - set(TABLES)))}")
+    ssl = False if args.ssl == "disable" else args.ssl
+
+    asyncio.run(run_import(args.source, args.dsn, ssl, args.jobs, args.chunk, only))
+
+
+if __name__ == "__main__":
+    main()
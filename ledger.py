@@ -0,0 +1,173 @@
+import asyncio
+import glob
+import json
+import os
+import time
+
+
+class LedgerQueue:
+    """Write-behind buffer for balancehistory rows.
+
+    Rows are (UserID, BalanceChange, BalanceAfter, Timestamp, Reason).
+    put() only appends to memory (and to the spill file, if one is set);
+    a background task hands the buffer to insert() once flush_rows are
+    waiting or every flush_interval seconds. When max_rows are buffered
+    put() waits for the next flush.
+
+    The spill file is written in generations, <spill_path>.<n>, one per
+    flush. A generation is deleted once every row in it is in the
+    database; whatever is left over after a crash is loaded back into the
+    buffer on startup.
+    """
+
+    def __init__(
+        self,
+        insert,
+        max_rows: int = None,
+        flush_rows: int = None,
+        flush_interval: float = None,
+        spill_path: str = None,
+        fsync: bool = None
+    ):
+        self.insert = insert
+        self.max_rows = max_rows or int(os.getenv("LEDGER_MAX_ROWS", "10000"))
+        self.flush_rows = flush_rows or int(os.getenv("LEDGER_FLUSH_ROWS", "500"))
+        self.flush_interval = flush_interval or float(os.getenv("LEDGER_FLUSH_INTERVAL", "1"))
+        self.spill_path = spill_path if spill_path is not None else os.getenv("LEDGER_SPILL_FILE")
+        self.fsync = fsync if fsync is not None else os.getenv("LEDGER_SPILL_FSYNC", "0") == "1"
+        self.rows = []
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+        self.blocked = 0
+        self.max_block = 0.0
+        self._space = asyncio.Condition()
+        self._due = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._spill = None
+        self._generation = 0
+        if self.spill_path:
+            self._recover()
+
+    def _generations(self):
+        found = []
+        for path in glob.glob(glob.escape(self.spill_path) + ".*"):
+            suffix = path.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                found.append((int(suffix), path))
+        return sorted(found)
+
+    def _recover(self):
+        for generation, path in self._generations():
+            with open(path) as f:
+                for line in f:
+                    # a torn last line is the one row that never got written
+                    try:
+                        self.rows.append(tuple(json.loads(line)))
+                    except ValueError:
+                        pass
+            self._generation = generation
+        if self.rows:
+            print(f"Recovered {len(self.rows)} ledger rows from {self.spill_path}")
+        self._open_generation()
+
+    def _open_generation(self):
+        self._generation += 1
+        self._spill = open(f"{self.spill_path}.{self._generation}", "a")
+
+    def _write_spill(self, rows):
+        self._spill.writelines(json.dumps(row) + "\n" for row in rows)
+        self._spill.flush()
+        if self.fsync:
+            os.fsync(self._spill.fileno())
+
+    def start(self):
+        if self._flusher is not None:
+            return
+
+        async def flusher():
+            while True:
+                try:
+                    await asyncio.wait_for(self._due.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._due.clear()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"Ledger flush failed, will retry: {e}")
+
+        self._flusher = asyncio.create_task(flusher())
+
+    async def put(self, rows):
+        if not rows:
+            return
+        self.start()
+
+        if len(self.rows) >= self.max_rows:
+            requested = time.perf_counter()
+            self.blocked += 1
+            self._due.set()
+            async with self._space:
+                await self._space.wait_for(lambda: len(self.rows) < self.max_rows)
+            self.max_block = max(self.max_block, time.perf_counter() - requested)
+
+        if self._spill is not None:
+            self._write_spill(rows)
+        self.rows.extend(rows)
+        if len(self.rows) >= self.flush_rows:
+            self._due.set()
+
+    async def flush(self):
+        """Write out everything buffered so far; returns the number of rows."""
+        async with self._flush_lock:
+            if not self.rows:
+                return 0
+
+            rows, self.rows = self.rows, []
+            done_generation = self._generation
+            if self._spill is not None:
+                self._spill.close()
+                self._open_generation()
+            async with self._space:
+                self._space.notify_all()
+
+            try:
+                await self.insert(rows)
+            except BaseException:
+                # keep them, in order, ahead of anything put meanwhile
+                self.failures += 1
+                self.rows[:0] = rows
+                raise
+
+            self.flushed += len(rows)
+            self.flushes += 1
+            if self.spill_path:
+                for generation, path in self._generations():
+                    if generation <= done_generation:
+                        os.remove(path)
+            return len(rows)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            if not self.rows:
+                os.remove(f"{self.spill_path}.{self._generation}")
+
+    def snapshot(self):
+        return {
+            "buffered": len(self.rows),
+            "max_rows": self.max_rows,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "blocked": self.blocked,
+            "block_max_ms": round(self.max_block * 1000, 3),
+            "spill": bool(self.spill_path),
+        }
@@ -4,6 +4,7 @@ import os
 from dotenv import load_dotenv
 import bot
 from database import Database
+from migrations import check_plans, check_triggers, migrate
 
 load_dotenv()
 
@@ -11,11 +12,46 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+def report_warm_up(done, total):
+    print(f"Database pool warm-up: {done}/{total} connections ready")
+
+reconnecting = False
+
 @bot.event
 async def on_ready():
+    # on_ready fires again after a gateway reconnect, by which point idle
+    # pool connections may have been closed; main() warmed the first one
+    global reconnecting
+    if reconnecting:
+        try:
+            await bot.db.warm_up(report_warm_up)
+        except Exception as e:
+            # commands reopen anyway; the pool reconnects on first use instead
+            print(f"Database pool warm-up failed: {e}")
+    reconnecting = True
     await bot.tree.sync()
     print(f"✅ Logged in as {bot.user}")
 
+def needs_db(cog):
+    # the database cogs hold bot.db as self.db; only they wait while a
+    # reconnect warms the pool up again
+    return getattr(cog, "db", None) is not None
+
+async def db_ready(interaction: discord.Interaction):
+    cog = getattr(interaction.command, "binding", None)
+    if bot.db.ready.is_set() or not needs_db(cog):
+        return True
+    await interaction.response.send_message(
+        "Reconnecting to the database, try again in a few seconds.", ephemeral=True
+    )
+    return False
+
+bot.tree.interaction_check = db_ready
+
+@bot.check
+async def db_ready_prefix(ctx):
+    return bot.db.ready.is_set() or not needs_db(ctx.cog)
+
 extensions = [
     "radio",
     "fun",
@@ -36,18 +72,35 @@ async def load_extensions():
         except Exception as e:
             print(f"Failed to load {ext}: {e}")
 
+@bot.command(name="dbstats")
+@commands.is_owner()
+async def dbstats(ctx):
+    stats = bot.db.stats()
+    await ctx.send("```\n" + "\n".join(f"{k}: {v}" for k, v in stats.items()) + "\n```")
+
 @bot.command(name="close")
 @commands.is_owner()
 async def close(ctx):
     await ctx.send("Shutting down...")
+    flushed = await bot.db.flush_ledger()
+    print(f"Flushed {flushed} ledger rows before shutdown.")
     await bot.close()
 
 async def main():
     bot.db = await Database.create()
-    async with bot:
-        await load_extensions()
-        await bot.start(os.getenv("DISCORD_TOKEN"))
-    await bot.db.close()
+    await migrate(bot.db)
+    await check_plans(bot.db)
+    await check_triggers(bot.db)
+    await bot.db.warm_up(report_warm_up)
+    ranks = await bot.db.ranking()
+    print(f"Leaderboards loaded: {len(ranks)} users")
+    try:
+        async with bot:
+            await load_extensions()
+            await bot.start(os.getenv("DISCORD_TOKEN"))
+    finally:
+        # flushes the write-behind ledger even if the bot died
+        await bot.db.close()
 
 if __name__ == "__main__":
     import asyncio
@@ -0,0 +1,651 @@
+import time
+
+from database import DatabaseError
+
+# Versioned schema changes, applied in order and recorded in schema_version.
+# Each entry is (version, description, statements); statements is either a
+# list run on every backend or a dict of per-dialect lists. Never edit an
+# entry that has shipped, add a new one.
+MIGRATIONS = [
+    (1, "base economy schema", {
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS econ (
+                UserID BIGINT PRIMARY KEY,
+                Balance BIGINT NOT NULL DEFAULT 0,
+                LastVoteTime BIGINT NOT NULL DEFAULT 0,
+                LastTextTime BIGINT NOT NULL DEFAULT 0,
+                LastStealTime DOUBLE PRECISION NOT NULL DEFAULT 0,
+                BankBalance BIGINT NOT NULL DEFAULT 0,
+                InJail INTEGER NOT NULL DEFAULT 0,
+                Alertness INTEGER NOT NULL DEFAULT 0,
+                Wantedness INTEGER NOT NULL DEFAULT 0,
+                LuckModifier INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS banks (
+                BankName TEXT NOT NULL,
+                ShortName TEXT PRIMARY KEY,
+                InterestRate REAL NOT NULL,
+                WithdrawalFee REAL NOT NULL,
+                MinimumDeposit INTEGER NOT NULL,
+                SecurityModifier INTEGER NOT NULL,
+                MinimumDepositTime INTEGER NOT NULL,
+                Emoji TEXT,
+                Description TEXT,
+                Colour TEXT,
+                Thumbnail TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS bankaccounts (
+                UserID BIGINT NOT NULL,
+                Balance BIGINT NOT NULL DEFAULT 0,
+                BankType TEXT NOT NULL REFERENCES banks (ShortName),
+                LastDepositTime BIGINT NOT NULL DEFAULT 0,
+                Gain BIGINT NOT NULL DEFAULT 0,
+                Loss BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (UserID, BankType)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS balancehistory (
+                HistoryID BIGSERIAL PRIMARY KEY,
+                UserID BIGINT NOT NULL,
+                BalanceChange BIGINT NOT NULL,
+                BalanceAfter BIGINT NOT NULL,
+                Timestamp BIGINT NOT NULL,
+                Reason TEXT NOT NULL
+            )
+            """,
+        ],
+        # economy.db already carries these; this only matters for a new file
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS econ (
+                UserID TEXT PRIMARY KEY,
+                Balance INTEGER NOT NULL DEFAULT 0,
+                LastVoteTime INTEGER NOT NULL DEFAULT 0,
+                LastTextTime INTEGER NOT NULL DEFAULT 0,
+                LastStealTime INTEGER NOT NULL DEFAULT 0,
+                BankBalance INTEGER NOT NULL DEFAULT 0,
+                InJail INTEGER NOT NULL DEFAULT 0,
+                Alertness INTEGER NOT NULL DEFAULT 0,
+                Wantedness INTEGER NOT NULL DEFAULT 0,
+                Luck INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS banks (
+                BankName TEXT NOT NULL,
+                ShortName TEXT PRIMARY KEY,
+                InterestRate REAL NOT NULL,
+                WithdrawalFee REAL NOT NULL,
+                MinimumDeposit INTEGER NOT NULL,
+                SecurityModifier INTEGER NOT NULL,
+                MinimumDepositTime INTEGER NOT NULL,
+                Emoji TEXT,
+                Description TEXT,
+                Colour TEXT,
+                Thumbnail TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS bankaccounts (
+                UserID TEXT NOT NULL,
+                Balance INTEGER NOT NULL DEFAULT 0,
+                BankType TEXT NOT NULL REFERENCES banks (ShortName),
+                LastDepositTime INTEGER NOT NULL DEFAULT 0,
+                Gain INTEGER NOT NULL DEFAULT 0,
+                Loss INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (UserID, BankType)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS balancehistory (
+                HistoryID INTEGER PRIMARY KEY AUTOINCREMENT,
+                UserID TEXT NOT NULL REFERENCES econ (UserID),
+                BalanceChange INTEGER NOT NULL,
+                BalanceAfter INTEGER NOT NULL,
+                Timestamp INTEGER NOT NULL,
+                Reason TEXT NOT NULL
+            )
+            """,
+        ],
+    }),
+    (2, "indexes for the hot economy queries", [
+        # /ichiledger: one user's history, newest first
+        """
+        CREATE INDEX IF NOT EXISTS balancehistory_user_time_idx
+        ON balancehistory (UserID, Timestamp DESC)
+        """,
+        # /ichilb: top balances
+        "CREATE INDEX IF NOT EXISTS econ_balance_idx ON econ (Balance DESC)",
+        # hourly refresh: interest joins accounts to their bank, and the
+        # counter ticks only touch users who still have heat
+        "CREATE INDEX IF NOT EXISTS bankaccounts_banktype_idx ON bankaccounts (BankType)",
+        "CREATE INDEX IF NOT EXISTS econ_wanted_idx ON econ (UserID) WHERE Wantedness > 0",
+        "CREATE INDEX IF NOT EXISTS econ_alert_idx ON econ (UserID) WHERE Alertness > 0",
+    ]),
+    (3, "hourly passive income rollups", {
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS passiveincome (
+                UserID BIGINT NOT NULL,
+                Bucket BIGINT NOT NULL,
+                Amount BIGINT NOT NULL,
+                Credits INTEGER NOT NULL,
+                BalanceAfter BIGINT NOT NULL,
+                Timestamp BIGINT NOT NULL,
+                PRIMARY KEY (UserID, Bucket)
+            )
+            """,
+        ],
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS passiveincome (
+                UserID TEXT NOT NULL,
+                Bucket INTEGER NOT NULL,
+                Amount INTEGER NOT NULL,
+                Credits INTEGER NOT NULL,
+                BalanceAfter INTEGER NOT NULL,
+                Timestamp INTEGER NOT NULL,
+                PRIMARY KEY (UserID, Bucket)
+            )
+            """,
+        ],
+    }),
+    (4, "monthly balancehistory archive", {
+        "postgres": [
+            # the archiver walks balancehistory oldest first
+            "CREATE INDEX IF NOT EXISTS balancehistory_time_idx ON balancehistory (Timestamp)",
+            """
+            CREATE TABLE IF NOT EXISTS balancehistory_archive (
+                HistoryID BIGINT NOT NULL,
+                UserID BIGINT NOT NULL,
+                BalanceChange BIGINT NOT NULL,
+                BalanceAfter BIGINT NOT NULL,
+                Timestamp BIGINT NOT NULL,
+                Reason TEXT NOT NULL
+            ) PARTITION BY RANGE (Timestamp)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS balancehistory_archive_user_time_idx
+            ON balancehistory_archive (UserID, Timestamp)
+            """,
+        ],
+        "sqlite": [
+            "CREATE INDEX IF NOT EXISTS balancehistory_time_idx ON balancehistory (Timestamp)",
+            # one gzipped file per month; Rows is kept in step with the file
+            """
+            CREATE TABLE IF NOT EXISTS ledgerarchive (
+                Month TEXT PRIMARY KEY,
+                Path TEXT NOT NULL,
+                Rows INTEGER NOT NULL
+            )
+            """,
+        ],
+    }),
+    (5, "cache invalidation notifications", {
+        # every write to econ, bankaccounts or banks, from any process,
+        # publishes the changed UserIDs on econ_cache once it commits; over
+        # 300 of them (or banks, or TRUNCATE) is sent as "everything"
+        "postgres": [
+            """
+            CREATE OR REPLACE FUNCTION notify_econ_cache() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                ids BIGINT[];
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    SELECT array_agg(UserID) INTO ids
+                    FROM (SELECT DISTINCT UserID FROM old_rows LIMIT 301) AS changed;
+                ELSIF TG_OP IN ('INSERT', 'UPDATE') AND TG_TABLE_NAME <> 'banks' THEN
+                    SELECT array_agg(UserID) INTO ids
+                    FROM (SELECT DISTINCT UserID FROM new_rows LIMIT 301) AS changed;
+                END IF;
+
+                IF TG_OP <> 'TRUNCATE' AND TG_TABLE_NAME <> 'banks' THEN
+                    IF ids IS NULL THEN
+                        RETURN NULL;
+                    ELSIF cardinality(ids) > 300 THEN
+                        ids := NULL;
+                    END IF;
+                END IF;
+
+                PERFORM pg_notify('econ_cache', json_build_object(
+                    'table', TG_TABLE_NAME,
+                    'origin', current_setting('application_name'),
+                    'ids', ids
+                )::text);
+                RETURN NULL;
+            END
+            $$
+            """,
+            *(
+                statement
+                for table in ("econ", "bankaccounts")
+                for statement in (
+                    f"DROP TRIGGER IF EXISTS {table}_notify_insert ON {table}",
+                    f"""
+                    CREATE TRIGGER {table}_notify_insert AFTER INSERT ON {table}
+                    REFERENCING NEW TABLE AS new_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION notify_econ_cache()
+                    """,
+                    f"DROP TRIGGER IF EXISTS {table}_notify_update ON {table}",
+                    f"""
+                    CREATE TRIGGER {table}_notify_update AFTER UPDATE ON {table}
+                    REFERENCING NEW TABLE AS new_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION notify_econ_cache()
+                    """,
+                    f"DROP TRIGGER IF EXISTS {table}_notify_delete ON {table}",
+                    f"""
+                    CREATE TRIGGER {table}_notify_delete AFTER DELETE ON {table}
+                    REFERENCING OLD TABLE AS old_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION notify_econ_cache()
+                    """,
+                    f"DROP TRIGGER IF EXISTS {table}_notify_truncate ON {table}",
+                    f"""
+                    CREATE TRIGGER {table}_notify_truncate AFTER TRUNCATE ON {table}
+                    FOR EACH STATEMENT EXECUTE FUNCTION notify_econ_cache()
+                    """,
+                )
+            ),
+            "DROP TRIGGER IF EXISTS banks_notify ON banks",
+            """
+            CREATE TRIGGER banks_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON banks
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_econ_cache()
+            """,
+        ],
+        # no LISTEN/NOTIFY; a SQLite file has one bot process writing it
+        "sqlite": [],
+    }),
+    (6, "song data and commissions", {
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS songdata (
+                SongID INTEGER PRIMARY KEY,
+                PageName TEXT,
+                Name TEXT,
+                Singers TEXT,
+                Producers TEXT,
+                Duration INTEGER,
+                Units TEXT,
+                BPM TEXT,
+                GameDuration INTEGER,
+                ReleaseDate TEXT,
+                Easy INTEGER,
+                Normal INTEGER,
+                Hard INTEGER,
+                Expert INTEGER,
+                Master INTEGER,
+                Append TEXT,
+                NEasy INTEGER,
+                NNormal INTEGER,
+                NHard INTEGER,
+                NExpert INTEGER,
+                NMaster INTEGER,
+                NAppend TEXT,
+                Hash TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS availablecommissions (
+                UserID BIGINT,
+                ClearCondition TEXT,
+                UnitReq TEXT,
+                SongReq TEXT,
+                LevReq TEXT,
+                DiffReq INTEGER,
+                Reward INTEGER
+            )
+            """,
+        ],
+        # economy.db already carries these, under their original names
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS "songdata" (
+                "pagename" TEXT,
+                "songid" INTEGER,
+                "name" TEXT,
+                "singers" TEXT,
+                "producers" TEXT,
+                "duration" INTEGER,
+                "units" TEXT,
+                "bpm" TEXT,
+                "game duration" INTEGER,
+                "release date" TEXT,
+                "EASY" INTEGER,
+                "NORMAL" INTEGER,
+                "HARD" INTEGER,
+                "EXPERT" INTEGER,
+                "MASTER" INTEGER,
+                "APPEND" TEXT,
+                "NEASY" INTEGER,
+                "NNORMAL" INTEGER,
+                "NHARD" INTEGER,
+                "NEXPERT" INTEGER,
+                "NMASTER" INTEGER,
+                "NAPPEND" TEXT,
+                "hash" TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS "availablecommissions" (
+                "UserID" TEXT,
+                "ClearCondition" TEXT,
+                "UnitReq" TEXT,
+                "SongReq" TEXT,
+                "LevReq" TEXT,
+                "DiffReq" INTEGER,
+                "Reward" INTEGER
+            )
+            """,
+        ],
+    }),
+    (7, "ledger consistency checkpoints", {
+        # the newest HistoryID and passive income bucket each user's balance
+        # was last verified up to; the checker only sums rows past them
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS ledgercheckpoints (
+                UserID BIGINT PRIMARY KEY,
+                HistoryID BIGINT NOT NULL,
+                Bucket BIGINT NOT NULL,
+                BucketAmount BIGINT NOT NULL,
+                Balance BIGINT NOT NULL,
+                CheckedAt BIGINT NOT NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS balancehistory_user_id_idx ON balancehistory (UserID, HistoryID)",
+        ],
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS ledgercheckpoints (
+                UserID TEXT PRIMARY KEY,
+                HistoryID INTEGER NOT NULL,
+                Bucket INTEGER NOT NULL,
+                BucketAmount INTEGER NOT NULL,
+                Balance INTEGER NOT NULL,
+                CheckedAt INTEGER NOT NULL
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS balancehistory_user_id_idx ON balancehistory (UserID, HistoryID)",
+        ],
+    }),
+    (8, "lazy bank interest", {
+        # the hourly interest tick only moves interestclock on; an account
+        # is owed every tick since its SettledTick, and is settled whenever
+        # it's written. bankaccounts_live is every account as if it had
+        # been settled just now.
+        "postgres": [
+            """
+            CREATE TABLE IF NOT EXISTS interestclock (
+                ID INTEGER PRIMARY KEY CHECK (ID = 1),
+                Tick BIGINT NOT NULL
+            )
+            """,
+            "INSERT INTO interestclock (ID, Tick) VALUES (1, 0) ON CONFLICT (ID) DO NOTHING",
+            "ALTER TABLE bankaccounts ADD COLUMN IF NOT EXISTS SettledTick BIGINT NOT NULL DEFAULT 0",
+            # the old hourly FLOOR(Balance * InterestRate), once per tick:
+            # flooring every hour isn't balance * rate ^ ticks, and the
+            # result has to match what the eager update would have paid
+            """
+            CREATE OR REPLACE FUNCTION settle_interest(balance BIGINT, rate REAL, ticks BIGINT)
+            RETURNS BIGINT LANGUAGE plpgsql IMMUTABLE AS $$
+            DECLARE
+                settled BIGINT;
+            BEGIN
+                IF rate IS NULL OR ticks IS NULL THEN
+                    RETURN balance;
+                END IF;
+                FOR i IN 1..ticks LOOP
+                    settled := FLOOR(balance * rate);
+                    -- and from here on every tick pays the same
+                    EXIT WHEN settled = balance;
+                    balance := settled;
+                END LOOP;
+                RETURN balance;
+            END
+            $$
+            """,
+            """
+            CREATE OR REPLACE VIEW bankaccounts_live AS
+            SELECT
+                ba.UserID, ba.BankType, s.Balance, ba.LastDepositTime,
+                ba.Gain + GREATEST(s.Balance - ba.Balance, 0) AS Gain,
+                ba.Loss + GREATEST(ba.Balance - s.Balance, 0) AS Loss,
+                c.Tick AS SettledTick
+            FROM bankaccounts ba
+            JOIN interestclock c ON c.ID = 1
+            LEFT JOIN banks b ON b.ShortName = ba.BankType
+            CROSS JOIN LATERAL (
+                SELECT settle_interest(ba.Balance, b.InterestRate, c.Tick - ba.SettledTick) AS Balance
+            ) AS s
+            """,
+            # ticks an account hasn't been settled for are paid at the bank's
+            # current rate, so settle them before a new rate can reach back
+            """
+            CREATE OR REPLACE FUNCTION settle_bank_accounts() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                UPDATE bankaccounts ba
+                SET Balance = l.Balance, Gain = l.Gain, Loss = l.Loss, SettledTick = l.SettledTick
+                FROM bankaccounts_live l
+                WHERE l.UserID = ba.UserID AND l.BankType = ba.BankType
+                  AND ba.BankType = OLD.ShortName
+                  AND ba.SettledTick < l.SettledTick;
+                RETURN NEW;
+            END
+            $$
+            """,
+            "DROP TRIGGER IF EXISTS banks_settle_interest ON banks",
+            """
+            CREATE TRIGGER banks_settle_interest BEFORE UPDATE OF InterestRate ON banks
+            FOR EACH ROW WHEN (OLD.InterestRate IS DISTINCT FROM NEW.InterestRate)
+            EXECUTE FUNCTION settle_bank_accounts()
+            """,
+        ],
+        # settle_interest is registered on every connection by sqlitedb
+        "sqlite": [
+            """
+            CREATE TABLE IF NOT EXISTS interestclock (
+                ID INTEGER PRIMARY KEY CHECK (ID = 1),
+                Tick INTEGER NOT NULL
+            )
+            """,
+            "INSERT OR IGNORE INTO interestclock (ID, Tick) VALUES (1, 0)",
+            "ALTER TABLE bankaccounts ADD COLUMN SettledTick INTEGER NOT NULL DEFAULT 0",
+            """
+            CREATE VIEW IF NOT EXISTS bankaccounts_live AS
+            SELECT
+                UserID, BankType, Settled AS Balance, LastDepositTime,
+                Gain + MAX(Settled - Balance, 0) AS Gain,
+                Loss + MAX(Balance - Settled, 0) AS Loss,
+                Tick AS SettledTick
+            FROM (
+                SELECT
+                    ba.*, c.Tick,
+                    settle_interest(ba.Balance, b.InterestRate, c.Tick - ba.SettledTick) AS Settled
+                FROM bankaccounts ba
+                JOIN interestclock c ON c.ID = 1
+                LEFT JOIN banks b ON b.ShortName = ba.BankType
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS banks_settle_interest
+            BEFORE UPDATE OF InterestRate ON banks
+            WHEN OLD.InterestRate IS NOT NEW.InterestRate
+            BEGIN
+                UPDATE bankaccounts
+                SET (Balance, Gain, Loss, SettledTick) = (
+                    SELECT l.Balance, l.Gain, l.Loss, l.SettledTick
+                    FROM bankaccounts_live l
+                    WHERE l.UserID = bankaccounts.UserID AND l.BankType = bankaccounts.BankType
+                )
+                WHERE BankType = OLD.ShortName;
+            END
+            """,
+        ],
+    }),
+    (9, "heat decays from timestamps", {
+        # Wantedness and Alertness lose a point per full hour since they
+        # were last raised, worked out on read by heat() instead of an
+        # hourly UPDATE. Heat held today starts wearing off now.
+        "postgres": [
+            "ALTER TABLE econ ADD COLUMN IF NOT EXISTS WantednessTime BIGINT NOT NULL DEFAULT 0",
+            "ALTER TABLE econ ADD COLUMN IF NOT EXISTS AlertnessTime BIGINT NOT NULL DEFAULT 0",
+            "UPDATE econ SET WantednessTime = EXTRACT(EPOCH FROM now())::bigint WHERE Wantedness > 0",
+            "UPDATE econ SET AlertnessTime = EXTRACT(EPOCH FROM now())::bigint WHERE Alertness > 0",
+            """
+            CREATE OR REPLACE FUNCTION heat(value INTEGER, updated BIGINT, at BIGINT)
+            RETURNS INTEGER LANGUAGE sql IMMUTABLE AS $$
+                SELECT GREATEST(value - (GREATEST(at - updated, 0) / 3600)::integer, 0)
+            $$
+            """,
+            # only the hourly ticks used these
+            "DROP INDEX IF EXISTS econ_wanted_idx",
+            "DROP INDEX IF EXISTS econ_alert_idx",
+        ],
+        # heat is registered on every connection by sqlitedb
+        "sqlite": [
+            "ALTER TABLE econ ADD COLUMN WantednessTime INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE econ ADD COLUMN AlertnessTime INTEGER NOT NULL DEFAULT 0",
+            "UPDATE econ SET WantednessTime = CAST(strftime('%s', 'now') AS INTEGER) WHERE Wantedness > 0",
+            "UPDATE econ SET AlertnessTime = CAST(strftime('%s', 'now') AS INTEGER) WHERE Alertness > 0",
+            "DROP INDEX IF EXISTS econ_wanted_idx",
+            "DROP INDEX IF EXISTS econ_alert_idx",
+        ],
+    }),
+    (10, "banks deletes publish without a transition table", {
+        # banks_notify has no REFERENCING clause, so the DELETE branch of
+        # migration 5's function failed every DELETE FROM banks on old_rows
+        "postgres": [
+            """
+            CREATE OR REPLACE FUNCTION notify_econ_cache() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                ids BIGINT[];
+            BEGIN
+                IF TG_TABLE_NAME <> 'banks' THEN
+                    IF TG_OP = 'DELETE' THEN
+                        SELECT array_agg(UserID) INTO ids
+                        FROM (SELECT DISTINCT UserID FROM old_rows LIMIT 301) AS changed;
+                    ELSIF TG_OP IN ('INSERT', 'UPDATE') THEN
+                        SELECT array_agg(UserID) INTO ids
+                        FROM (SELECT DISTINCT UserID FROM new_rows LIMIT 301) AS changed;
+                    END IF;
+
+                    IF TG_OP <> 'TRUNCATE' THEN
+                        IF ids IS NULL THEN
+                            RETURN NULL;
+                        ELSIF cardinality(ids) > 300 THEN
+                            ids := NULL;
+                        END IF;
+                    END IF;
+                END IF;
+
+                PERFORM pg_notify('econ_cache', json_build_object(
+                    'table', TG_TABLE_NAME,
+                    'origin', current_setting('application_name'),
+                    'ids', ids
+                )::text);
+                RETURN NULL;
+            END
+            $$
+            """,
+        ],
+        "sqlite": [],
+    }),
+]
+
+# Registered queries that must be answered from an index, with sample
+# arguments to plan them with.
+HOT_QUERIES = {
+    "econ_row": (0,),
+    "heist_target": (0, "LNC", 0),
+    "ledger_recent": (0, 0, 3600),
+    "ledger_check_horizon": (),
+}
+
+
+# Writes that must get through every trigger on the table. Statement-level
+# triggers fire even when no row matches, so these change nothing.
+TRIGGER_CHECKS = [
+    "INSERT INTO banks SELECT * FROM banks WHERE FALSE",
+    "UPDATE banks SET InterestRate = InterestRate WHERE FALSE",
+    "DELETE FROM banks WHERE FALSE",
+    "DELETE FROM bankaccounts WHERE FALSE",
+    "DELETE FROM econ WHERE FALSE",
+]
+
+
+async def migrate(db):
+    """Bring the schema up to the newest version in MIGRATIONS."""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            Version INTEGER PRIMARY KEY,
+            Description TEXT NOT NULL,
+            AppliedAt BIGINT NOT NULL
+        )
+        """
+    )
+
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if isinstance(statements, dict):
+            statements = statements[db.dialect]
+
+        async with db.transaction() as conn:
+            if db.dialect == "postgres":
+                # two bots starting at once must not both run a migration
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+            if await conn.fetchval("SELECT 1 FROM schema_version WHERE Version = $1", version):
+                continue
+
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute(
+                "INSERT INTO schema_version (Version, Description, AppliedAt) VALUES ($1, $2, $3)",
+                version, description, int(time.time())
+            )
+        applied.append(version)
+        print(f"Applied migration {version}: {description}")
+
+    if applied:
+        # a DDL change can leave the cached rows stale
+        db.cache.invalidate()
+    return applied
+
+
+async def check_plans(db):
+    """Raise DatabaseError if any HOT_QUERIES entry plans a sequential scan."""
+    failures = {}
+    for name, args in HOT_QUERIES.items():
+        scanned = await db.sequential_scans(name, *args)
+        if scanned:
+            failures[name] = scanned
+
+    if failures:
+        raise DatabaseError(
+            "Hot queries fall back to sequential scans: "
+            + ", ".join(f"{name} ({', '.join(tables)})" for name, tables in failures.items())
+        )
+
+
+async def check_triggers(db):
+    """Raise DatabaseError if any TRIGGER_CHECKS write fails."""
+    failures = {}
+    for statement in TRIGGER_CHECKS:
+        try:
+            await db.execute(statement)
+        except Exception as e:
+            failures[statement] = e
+
+    if failures:
+        raise DatabaseError(
+            "Writes fail in their triggers: "
+            + "; ".join(f"{statement} ({e})" for statement, e in failures.items())
+        )
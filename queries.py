@@ -0,0 +1,604 @@
+# Named SQL used by the cogs and Database. In prepared-statement mode each
+# entry is prepared on a pooled connection the first time it runs there, and
+# asyncpg's statement cache reuses that statement from then on.
+# The balance mutations take a trailing boolean parameter: true writes the
+# balancehistory rows in the same statement, false leaves them to
+# Database's write-behind ledger queue.
+QUERIES = {
+    "econ_row": "SELECT * FROM econ WHERE UserID = $1",
+    # Wantedness and Alertness are stored as of their *Time column and
+    # wear off from there (heat() in migration 9); raising one restarts
+    # its clock at $3.
+    "econ_add_wantedness": """
+        UPDATE econ
+        SET Wantedness = heat(Wantedness, WantednessTime, $3) + $2, WantednessTime = $3
+        WHERE UserID = $1
+        RETURNING Wantedness, WantednessTime
+    """,
+    "econ_set_wantedness": """
+        UPDATE econ SET Wantedness = $2, WantednessTime = $3
+        WHERE UserID = $1
+        RETURNING Wantedness, WantednessTime
+    """,
+    # the tierlist cog's once-a-day participation payout
+    "last_vote_time": "SELECT LastVoteTime FROM econ WHERE UserID = $1",
+    "set_last_vote_time": "UPDATE econ SET LastVoteTime = $1 WHERE UserID = $2",
+    # Rows for the in-memory leaderboards (dbrank.RankIndex): each user's
+    # wallet and settled bank accounts, one row per account.
+    "rank_all": """
+        SELECT e.UserID, e.Balance, a.BankType, a.Balance
+        FROM econ e
+        LEFT JOIN bankaccounts_live a ON a.UserID = e.UserID
+    """,
+    # Same, for the users in $1 that another process wrote.
+    "rank_users": """
+        SELECT e.UserID, e.Balance, a.BankType, a.Balance
+        FROM econ e
+        LEFT JOIN bankaccounts_live a ON a.UserID = e.UserID
+        WHERE e.UserID = ANY($1::bigint[])
+    """,
+
+    "heist_target": """
+        SELECT
+            u.UserID, ba.Balance, heat(u.Alertness, u.AlertnessTime, $3) AS Alertness,
+            b.SecurityModifier
+        FROM bankaccounts_live ba
+        INNER JOIN banks b ON ba.BankType = b.ShortName
+        INNER JOIN econ u ON ba.UserID = u.UserID
+        WHERE u.UserID = $1 AND b.ShortName = $2
+    """,
+    "heist_freeze_accounts": "DELETE FROM bankaccounts WHERE UserID = $1",
+    "heist_freeze_wallet": """
+        UPDATE econ SET balance = FLOOR(balance/2)
+        WHERE UserID = $1
+        RETURNING Balance
+    """,
+
+    "banks_all": "SELECT * FROM banks ORDER BY ShortName",
+    # /ichiportfolio: one row per bank (or a single row with a NULL
+    # BankType if there are none), each carrying the wallet and the
+    # Wanted level as of $2
+    "portfolio": """
+        SELECT
+            COALESCE(e.Balance, 0) AS Wallet,
+            heat(COALESCE(e.Wantedness, 0), COALESCE(e.WantednessTime, 0), $2) AS Wanted,
+            b.ShortName AS BankType,
+            COALESCE(a.Balance, 0) AS Balance
+        FROM (SELECT 1) AS one
+        LEFT JOIN econ e ON e.UserID = $1
+        LEFT JOIN banks b ON TRUE
+        LEFT JOIN bankaccounts_live a ON a.UserID = $1 AND a.BankType = b.ShortName
+        ORDER BY b.ShortName
+    """,
+    # Checks and moves in one statement. econ is always locked before
+    # bankaccounts so concurrent deposits, withdrawals and heists queue on
+    # the same rows in the same order. The account is settled up to the
+    # current interest tick before the move is applied. $3 is cast where it
+    # first appears, or Postgres would infer int4 from the literal beside it.
+    "bank_move": """
+        WITH bank AS (
+            SELECT MinimumDepositTime, MinimumDeposit
+            FROM banks
+            WHERE ShortName = $2
+        ), wallet AS (
+            SELECT Balance
+            FROM econ
+            WHERE UserID = $1
+            FOR UPDATE
+        ), clock AS (
+            SELECT Tick FROM interestclock WHERE ID = 1
+        ), account AS (
+            SELECT
+                s.Balance,
+                s.Balance - ba.Balance AS Interest,
+                ba.LastDepositTime
+            FROM bankaccounts ba
+            CROSS JOIN clock c
+            LEFT JOIN banks b ON b.ShortName = ba.BankType
+            CROSS JOIN LATERAL (
+                SELECT settle_interest(ba.Balance, b.InterestRate, c.Tick - ba.SettledTick) AS Balance
+            ) AS s
+            WHERE ba.UserID = $1
+              AND ba.BankType = $2
+              AND (SELECT COUNT(*) FROM wallet) >= 0
+            FOR UPDATE OF ba
+        ), verdict AS (
+            SELECT
+                CASE
+                    WHEN b.MinimumDeposit IS NULL THEN 'bank'
+                    WHEN $3::bigint < 0 AND NOT $5
+                        AND $4 - COALESCE(a.LastDepositTime, 0) < b.MinimumDepositTime
+                        THEN 'cooldown'
+                    WHEN $3 > 0 AND $3 < b.MinimumDeposit THEN 'minimum'
+                    WHEN COALESCE(a.Balance, 0) + $3 < 0
+                        OR (NOT $5 AND COALESCE(w.Balance, 0) < $3)
+                        THEN 'funds'
+                    ELSE 'ok'
+                END AS Status,
+                b.MinimumDeposit
+            FROM (SELECT 1) AS one
+            LEFT JOIN bank b ON TRUE
+            LEFT JOIN wallet w ON TRUE
+            LEFT JOIN account a ON TRUE
+        ), wallet_update AS (
+            INSERT INTO econ (UserID, Balance)
+            SELECT $1, -$3
+            FROM verdict
+            WHERE Status = 'ok' AND NOT $5
+            ON CONFLICT (UserID)
+            DO UPDATE SET Balance = econ.Balance + EXCLUDED.Balance
+            RETURNING Balance
+        ), history AS (
+            INSERT INTO balancehistory
+                (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+            SELECT $1, -$3, Balance, $4, $6
+            FROM wallet_update
+            WHERE $7
+        ), account_update AS (
+            INSERT INTO bankaccounts
+                (UserID, BankType, Balance, LastDepositTime, SettledTick)
+            SELECT $1, $2, $3, $4, (SELECT Tick FROM clock)
+            FROM verdict
+            WHERE Status = 'ok'
+            ON CONFLICT (UserID, BankType)
+            DO UPDATE SET
+                Balance = bankaccounts.Balance
+                    + COALESCE((SELECT Interest FROM account), 0) + EXCLUDED.Balance,
+                Gain = bankaccounts.Gain + GREATEST(COALESCE((SELECT Interest FROM account), 0), 0),
+                Loss = bankaccounts.Loss + GREATEST(-COALESCE((SELECT Interest FROM account), 0), 0),
+                SettledTick = EXCLUDED.SettledTick,
+                LastDepositTime = CASE
+                    WHEN EXCLUDED.Balance > 0 THEN EXCLUDED.LastDepositTime
+                    ELSE bankaccounts.LastDepositTime
+                END
+            RETURNING Balance
+        )
+        SELECT
+            v.Status,
+            v.MinimumDeposit,
+            (SELECT Balance FROM wallet_update) AS Wallet,
+            (SELECT Balance FROM account_update) AS Account
+        FROM verdict v
+    """,
+    "lock_econ": "SELECT Balance FROM econ WHERE UserID = $1 FOR UPDATE",
+
+    # $3 is the passive income bucket width: a rollup last credited at or
+    # after $1 can't have started more than one bucket before it
+    "ledger_recent": """
+        SELECT BalanceChange, BalanceAfter, Timestamp, Reason
+        FROM (
+            SELECT BalanceChange, BalanceAfter, Timestamp, Reason
+            FROM balancehistory
+            WHERE Timestamp >= $1 AND UserID = $2
+            UNION ALL
+            SELECT Amount, BalanceAfter, Timestamp, 'Passive Income'
+            FROM passiveincome
+            WHERE UserID = $2 AND Bucket > $1 - $3 AND Timestamp >= $1
+        ) AS ledger
+        ORDER BY Timestamp DESC
+        LIMIT 100
+    """,
+
+    "ledger_oldest": "SELECT MIN(Timestamp) FROM balancehistory",
+    # Moves up to $2 of the oldest rows from before $1 into the archive,
+    # which routes each to its month's partition. SKIP LOCKED keeps it out
+    # of the way of anything else touching those rows.
+    "archive_ledger_batch": """
+        WITH batch AS (
+            SELECT HistoryID
+            FROM balancehistory
+            WHERE Timestamp < $1
+            ORDER BY Timestamp
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        ), moved AS (
+            DELETE FROM balancehistory h
+            USING batch b
+            WHERE h.HistoryID = b.HistoryID
+            RETURNING h.HistoryID, h.UserID, h.BalanceChange, h.BalanceAfter, h.Timestamp, h.Reason
+        ), archived AS (
+            INSERT INTO balancehistory_archive
+                (HistoryID, UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+            SELECT * FROM moved
+            RETURNING 1
+        )
+        SELECT COUNT(*) FROM archived
+    """,
+    # reltuples is the planner's estimate; counting would read every row
+    "ledger_partitions": """
+        SELECT
+            c.relname AS Name,
+            GREATEST(c.reltuples, 0)::bigint AS Rows,
+            pg_total_relation_size(c.oid) AS Bytes
+        FROM pg_class c
+        WHERE c.oid = 'balancehistory'::regclass
+           OR c.oid IN (
+               SELECT inhrelid
+               FROM pg_inherits
+               WHERE inhparent = 'balancehistory_archive'::regclass
+           )
+        ORDER BY c.relname
+    """,
+    # everything /ichiexport writes out; $1 is a user id, or NULL for everyone
+    "ledger_export": """
+        SELECT UserID, BalanceChange, BalanceAfter, Timestamp, Reason
+        FROM (
+            SELECT UserID, BalanceChange, BalanceAfter, Timestamp, Reason
+            FROM balancehistory_archive
+            WHERE $1::bigint IS NULL OR UserID = $1
+            UNION ALL
+            SELECT UserID, BalanceChange, BalanceAfter, Timestamp, Reason
+            FROM balancehistory
+            WHERE $1::bigint IS NULL OR UserID = $1
+            UNION ALL
+            SELECT UserID, Amount, BalanceAfter, Timestamp, 'Passive Income'
+            FROM passiveincome
+            WHERE $1::bigint IS NULL OR UserID = $1
+        ) AS ledger
+        ORDER BY Timestamp, UserID
+    """,
+
+    # Expected balance for each user in $1: their checkpoint plus every
+    # ledger row past it. Archived rows are only read for users that have
+    # never been checked; the checker runs well inside the retention window.
+    # A passive income bucket keeps growing, so the one the checkpoint ended
+    # in counts only what was added to it since.
+    # The new checkpoint stops at HistoryID $2 (see check_ledger); Pending is
+    # the part of Expected past it, left for the next check to sum again.
+    "ledger_check_batch": """
+        WITH users AS (
+            SELECT
+                e.UserID, e.Balance, c.HistoryID AS CheckedID, c.Bucket AS CheckedBucket,
+                c.BucketAmount AS CheckedAmount, c.Balance AS CheckedBalance
+            FROM econ e
+            LEFT JOIN ledgercheckpoints c ON c.UserID = e.UserID
+            WHERE e.UserID = ANY($1::bigint[])
+        ), history AS (
+            SELECT
+                h.UserID,
+                SUM(h.BalanceChange) AS Delta,
+                SUM(CASE WHEN h.HistoryID > $2 THEN h.BalanceChange ELSE 0 END) AS Pending,
+                MAX(CASE WHEN h.HistoryID <= $2 THEN h.HistoryID END) AS LastID
+            FROM users u
+            JOIN balancehistory h
+                ON h.UserID = u.UserID AND h.HistoryID > COALESCE(u.CheckedID, 0)
+            GROUP BY h.UserID
+        ), archived AS (
+            SELECT a.UserID, SUM(a.BalanceChange) AS Delta, MAX(a.HistoryID) AS LastID
+            FROM users u
+            JOIN balancehistory_archive a ON a.UserID = u.UserID
+            WHERE u.CheckedID IS NULL
+            GROUP BY a.UserID
+        ), passive AS (
+            SELECT
+                p.UserID,
+                SUM(p.Amount) - COALESCE(
+                    MAX(CASE WHEN p.Bucket = u.CheckedBucket THEN u.CheckedAmount END), 0
+                ) AS Delta,
+                MAX(p.Bucket) AS LastBucket
+            FROM users u
+            JOIN passiveincome p
+                ON p.UserID = u.UserID AND p.Bucket >= COALESCE(u.CheckedBucket, 0)
+            GROUP BY p.UserID
+        )
+        SELECT
+            u.UserID,
+            u.Balance,
+            (COALESCE(u.CheckedBalance, 0) + COALESCE(h.Delta, 0)
+                + COALESCE(a.Delta, 0) + COALESCE(p.Delta, 0))::bigint AS Expected,
+            COALESCE(h.Pending, 0) AS Pending,
+            u.CheckedBalance IS NOT NULL AS Checked,
+            COALESCE(u.CheckedID, 0) AS CheckedID,
+            COALESCE(u.CheckedBucket, 0) AS CheckedBucket,
+            GREATEST(COALESCE(u.CheckedID, 0), COALESCE(h.LastID, 0), COALESCE(a.LastID, 0)) AS HistoryID,
+            COALESCE(p.LastBucket, u.CheckedBucket, 0) AS Bucket,
+            COALESCE(pb.Amount, u.CheckedAmount, 0) AS BucketAmount
+        FROM users u
+        LEFT JOIN history h ON h.UserID = u.UserID
+        LEFT JOIN archived a ON a.UserID = u.UserID
+        LEFT JOIN passive p ON p.UserID = u.UserID
+        LEFT JOIN passiveincome pb ON pb.UserID = u.UserID AND pb.Bucket = p.LastBucket
+    """,
+    "ledger_check_users": "SELECT UserID FROM econ ORDER BY UserID",
+    "ledger_check_horizon": "SELECT COALESCE(MAX(HistoryID), 0) FROM balancehistory",
+    # the ledger rows a mismatch was summed from, newest first
+    "ledger_check_rows": """
+        SELECT HistoryID, BalanceChange, BalanceAfter, Timestamp, Reason
+        FROM (
+            SELECT HistoryID, BalanceChange, BalanceAfter, Timestamp, Reason
+            FROM balancehistory
+            WHERE UserID = $1 AND HistoryID > $2
+            UNION ALL
+            SELECT NULL, Amount, BalanceAfter, Timestamp, 'Passive Income'
+            FROM passiveincome
+            WHERE UserID = $1 AND Bucket >= $3
+        ) AS ledger
+        ORDER BY Timestamp DESC
+        LIMIT 20
+    """,
+    "ledger_checkpoint_save": """
+        INSERT INTO ledgercheckpoints
+            (UserID, HistoryID, Bucket, BucketAmount, Balance, CheckedAt)
+        SELECT c.*, $6
+        FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::bigint[]) AS c
+        ON CONFLICT (UserID) DO UPDATE SET
+            HistoryID = EXCLUDED.HistoryID,
+            Bucket = EXCLUDED.Bucket,
+            BucketAmount = EXCLUDED.BucketAmount,
+            Balance = EXCLUDED.Balance,
+            CheckedAt = EXCLUDED.CheckedAt
+    """,
+    "ledger_insert": """
+        INSERT INTO balancehistory (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+        VALUES ($1, $2, $3, $4, $5)
+    """,
+
+    # Accounts are settled lazily against this (see bankaccounts_live).
+    "tick_interest": "UPDATE interestclock SET Tick = Tick + 1 WHERE ID = 1",
+    # Settles up to $2 accounts at least $1 ticks behind the clock, longest
+    # first, so bankaccounts_live never loops over more than that many ticks
+    # for them. What the view shows doesn't change.
+    "settle_stale_accounts": """
+        WITH stale AS (
+            SELECT ba.UserID, ba.BankType
+            FROM bankaccounts ba
+            JOIN interestclock c ON c.ID = 1
+            WHERE ba.SettledTick <= c.Tick - $1
+            ORDER BY ba.SettledTick
+            LIMIT $2
+            FOR UPDATE OF ba SKIP LOCKED
+        ), settled AS (
+            UPDATE bankaccounts ba
+            SET Balance = l.Balance, Gain = l.Gain, Loss = l.Loss, SettledTick = l.SettledTick
+            FROM stale s
+            JOIN bankaccounts_live l ON l.UserID = s.UserID AND l.BankType = s.BankType
+            WHERE ba.UserID = s.UserID AND ba.BankType = s.BankType
+            RETURNING 1
+        )
+        SELECT COUNT(*) FROM settled
+    """,
+
+    "change_balance": """
+        WITH updated AS (
+            INSERT INTO econ (UserID, Balance)
+            VALUES ($1, $2)
+            ON CONFLICT (UserID)
+            DO UPDATE SET Balance = econ.Balance + EXCLUDED.Balance
+            RETURNING Balance
+        ), history AS (
+            INSERT INTO balancehistory
+                (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+            SELECT $1, $2, Balance, $3, $4
+            FROM updated
+            WHERE $5
+        )
+        SELECT Balance FROM updated
+    """,
+    # $1..$6 are per-participant arrays (both users, sorted by id); the
+    # debited party is $7 and must hold $8 unless $9 is false; $11 is the
+    # inline ledger flag. Rows are
+    # locked in UserID order so two transfers between the same pair of users
+    # can never wait on each other.
+    "transfer": """
+        WITH input AS (
+            SELECT *
+            FROM unnest(
+                $1::bigint[], $2::bigint[], $3::text[],
+                $4::integer[], $5::integer[], $6::float8[]
+            ) AS t(UserID, Delta, Reason, Wantedness, Alertness, LastStealTime)
+        ), locked AS (
+            SELECT UserID, Balance
+            FROM econ
+            WHERE UserID = ANY($1::bigint[])
+            ORDER BY UserID
+            FOR UPDATE
+        ), verdict AS (
+            SELECT
+                NOT $9 OR COALESCE(
+                    (SELECT Balance FROM locked WHERE UserID = $7), 0
+                ) >= $8 AS Ok
+        ), updated AS (
+            INSERT INTO econ
+                (UserID, Balance, Wantedness, Alertness, LastStealTime, WantednessTime, AlertnessTime)
+            SELECT i.UserID, i.Delta, i.Wantedness, i.Alertness, i.LastStealTime, $10, $10
+            FROM input i, verdict v
+            WHERE v.Ok
+            ON CONFLICT (UserID)
+            DO UPDATE SET
+                Balance = econ.Balance + EXCLUDED.Balance,
+                Wantedness = CASE
+                    WHEN EXCLUDED.Wantedness = 0 THEN econ.Wantedness
+                    ELSE heat(econ.Wantedness, econ.WantednessTime, $10) + EXCLUDED.Wantedness
+                END,
+                WantednessTime = CASE
+                    WHEN EXCLUDED.Wantedness = 0 THEN econ.WantednessTime
+                    ELSE $10
+                END,
+                Alertness = CASE
+                    WHEN EXCLUDED.Alertness = 0 THEN econ.Alertness
+                    ELSE heat(econ.Alertness, econ.AlertnessTime, $10) + EXCLUDED.Alertness
+                END,
+                AlertnessTime = CASE
+                    WHEN EXCLUDED.Alertness = 0 THEN econ.AlertnessTime
+                    ELSE $10
+                END,
+                LastStealTime = GREATEST(econ.LastStealTime, EXCLUDED.LastStealTime)
+            RETURNING
+                UserID, Balance, Wantedness, Alertness, LastStealTime,
+                WantednessTime, AlertnessTime
+        ), history AS (
+            INSERT INTO balancehistory
+                (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+            SELECT i.UserID, i.Delta, u.Balance, $10, i.Reason
+            FROM input i
+            JOIN updated u ON u.UserID = i.UserID
+            WHERE i.Reason IS NOT NULL AND $11
+        )
+        SELECT
+            v.Ok, NULL::bigint AS AccountBalance,
+            u.UserID, u.Balance, u.Wantedness, u.Alertness, u.LastStealTime,
+            u.WantednessTime, u.AlertnessTime
+        FROM verdict v
+        LEFT JOIN updated u ON TRUE
+    """,
+    # Same as transfer, but $7's side comes out of their $11 bank account
+    # and the ledger flag moves to $12.
+    # econ rows are locked before the bankaccounts row, as in bank_move.
+    "transfer_from_bank": """
+        WITH input AS (
+            SELECT *
+            FROM unnest(
+                $1::bigint[], $2::bigint[], $3::text[],
+                $4::integer[], $5::integer[], $6::float8[]
+            ) AS t(UserID, Delta, Reason, Wantedness, Alertness, LastStealTime)
+        ), locked AS (
+            SELECT UserID
+            FROM econ
+            WHERE UserID = ANY($1::bigint[])
+            ORDER BY UserID
+            FOR UPDATE
+        ), account AS (
+            SELECT s.Balance, s.Balance - ba.Balance AS Interest, c.Tick
+            FROM bankaccounts ba
+            JOIN interestclock c ON c.ID = 1
+            LEFT JOIN banks b ON b.ShortName = ba.BankType
+            CROSS JOIN LATERAL (
+                SELECT settle_interest(ba.Balance, b.InterestRate, c.Tick - ba.SettledTick) AS Balance
+            ) AS s
+            WHERE ba.UserID = $7
+              AND ba.BankType = $11
+              AND (SELECT COUNT(*) FROM locked) >= 0
+            FOR UPDATE OF ba
+        ), verdict AS (
+            SELECT
+                NOT $9 OR COALESCE((SELECT Balance FROM account), 0) >= $8 AS Ok
+        ), account_update AS (
+            UPDATE bankaccounts ba
+            SET
+                Balance = ba.Balance + a.Interest - $8,
+                Gain = ba.Gain + GREATEST(a.Interest, 0),
+                Loss = ba.Loss + GREATEST(-a.Interest, 0),
+                SettledTick = a.Tick
+            FROM verdict v, account a
+            WHERE ba.UserID = $7 AND ba.BankType = $11 AND v.Ok
+            RETURNING ba.Balance
+        ), updated AS (
+            INSERT INTO econ
+                (UserID, Balance, Wantedness, Alertness, LastStealTime, WantednessTime, AlertnessTime)
+            SELECT i.UserID, i.Delta, i.Wantedness, i.Alertness, i.LastStealTime, $10, $10
+            FROM input i, verdict v
+            WHERE v.Ok
+            ON CONFLICT (UserID)
+            DO UPDATE SET
+                Balance = econ.Balance + EXCLUDED.Balance,
+                Wantedness = CASE
+                    WHEN EXCLUDED.Wantedness = 0 THEN econ.Wantedness
+                    ELSE heat(econ.Wantedness, econ.WantednessTime, $10) + EXCLUDED.Wantedness
+                END,
+                WantednessTime = CASE
+                    WHEN EXCLUDED.Wantedness = 0 THEN econ.WantednessTime
+                    ELSE $10
+                END,
+                Alertness = CASE
+                    WHEN EXCLUDED.Alertness = 0 THEN econ.Alertness
+                    ELSE heat(econ.Alertness, econ.AlertnessTime, $10) + EXCLUDED.Alertness
+                END,
+                AlertnessTime = CASE
+                    WHEN EXCLUDED.Alertness = 0 THEN econ.AlertnessTime
+                    ELSE $10
+                END,
+                LastStealTime = GREATEST(econ.LastStealTime, EXCLUDED.LastStealTime)
+            RETURNING
+                UserID, Balance, Wantedness, Alertness, LastStealTime,
+                WantednessTime, AlertnessTime
+        ), history AS (
+            INSERT INTO balancehistory
+                (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+            SELECT i.UserID, i.Delta, u.Balance, $10, i.Reason
+            FROM input i
+            JOIN updated u ON u.UserID = i.UserID
+            WHERE i.Reason IS NOT NULL AND $12
+        )
+        SELECT
+            v.Ok, (SELECT Balance FROM account_update) AS AccountBalance,
+            u.UserID, u.Balance, u.Wantedness, u.Alertness, u.LastStealTime,
+            u.WantednessTime, u.AlertnessTime
+        FROM verdict v
+        LEFT JOIN updated u ON TRUE
+    """,
+    # Credits each user in $1 the matching amount in $2 (ids unique) and
+    # folds it into their rollup row for bucket $3 instead of writing a
+    # ledger row per credit.
+    "passive_income": """
+        WITH credits AS (
+            SELECT UserID, Amount
+            FROM unnest($1::bigint[], $2::bigint[]) AS t(UserID, Amount)
+        ), updated AS (
+            INSERT INTO econ (UserID, Balance)
+            SELECT UserID, Amount
+            FROM credits
+            ORDER BY UserID
+            ON CONFLICT (UserID)
+            DO UPDATE SET Balance = econ.Balance + EXCLUDED.Balance
+            RETURNING UserID, Balance
+        ), rollup AS (
+            INSERT INTO passiveincome
+                (UserID, Bucket, Amount, Credits, BalanceAfter, Timestamp)
+            SELECT u.UserID, $3, c.Amount, 1, u.Balance, $4
+            FROM updated u
+            JOIN credits c ON c.UserID = u.UserID
+            ON CONFLICT (UserID, Bucket)
+            DO UPDATE SET
+                Amount = passiveincome.Amount + EXCLUDED.Amount,
+                Credits = passiveincome.Credits + 1,
+                BalanceAfter = EXCLUDED.BalanceAfter,
+                Timestamp = EXCLUDED.Timestamp
+        )
+        SELECT UserID, Balance FROM updated
+    """,
+    "change_balances": """
+        WITH input AS (
+            SELECT *
+            FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::bigint[])
+                WITH ORDINALITY
+                AS t(UserID, BalanceChange, Reason, Timestamp, Seq)
+        ), totals AS (
+            SELECT UserID, SUM(BalanceChange) AS Delta
+            FROM input
+            GROUP BY UserID
+        ), updated AS (
+            INSERT INTO econ (UserID, Balance)
+            SELECT UserID, Delta FROM totals
+            ORDER BY UserID
+            ON CONFLICT (UserID)
+            DO UPDATE SET Balance = econ.Balance + EXCLUDED.Balance
+            RETURNING UserID, Balance
+        ), history AS (
+            INSERT INTO balancehistory
+                (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+            SELECT
+                i.UserID,
+                i.BalanceChange,
+                u.Balance - t.Delta + SUM(i.BalanceChange) OVER (
+                    PARTITION BY i.UserID ORDER BY i.Seq
+                ),
+                i.Timestamp,
+                i.Reason
+            FROM input i
+            JOIN totals t ON t.UserID = i.UserID
+            JOIN updated u ON u.UserID = i.UserID
+            WHERE $5
+            ORDER BY i.Seq
+        )
+        SELECT UserID, Balance FROM updated
+    """,
+    # seconds the replica is behind; 0 for a primary or a replica that has
+    # replayed everything it received (an idle primary writes no new xacts)
+    "replica_lag": """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END::float8
+    """,
+}
@@ -0,0 +1,231 @@
+"""Round-trip budgets for the economy commands.
+
+Runs each Economy app command against a Database whose asyncpg pool is
+replaced by a recording fake, then checks how many queries (round trips)
+and pool checkouts it took against BUDGETS. Needs no network, no Postgres
+and no Discord connection:
+
+    python roundtrips.py
+
+Exits non-zero if any command goes over budget. When a change really does
+need another query on a hot path, raise its budget here in the same commit.
+"""
+import asyncio
+import contextlib
+import sys
+from types import SimpleNamespace
+
+from database import Database
+from queries import QUERIES
+from sqlitedb import Record
+import economy
+
+# command: (round trips, pool acquires), measured with a cold econ cache
+# and leaderboard index
+BUDGETS = {
+    "ichirob": (3, 3),
+    "ichiheist": (3, 3),
+    "ichiportfolio": (1, 1),
+    "ichiledger": (1, 1),
+    "ichilb": (1, 1),
+    "ichirank": (1, 1),
+    "ichideposit": (1, 1),
+    "ichiwithdraw": (1, 1),
+    "ichitransfer": (1, 1),
+}
+
+USER = 100000000000000001
+TARGET = 100000000000000002
+
+_QUERY_NAMES = {sql: name for name, sql in QUERIES.items()}
+
+
+def _record(**fields):
+    return Record(tuple(fields.values()), {k: i for i, k in enumerate(fields)})
+
+
+def _econ(userID):
+    return _record(
+        userid=userID, balance=10000, lastvotetime=0, lasttexttime=0,
+        laststealtime=0.0, bankbalance=0, injail=0, alertness=0,
+        wantedness=0, luckmodifier=0, wantednesstime=0, alertnesstime=0
+    )
+
+
+def _transfer(args):
+    return [
+        _record(
+            ok=True, accountbalance=5000, userid=userID, balance=10000,
+            wantedness=0, alertness=0, laststealtime=0.0,
+            wantednesstime=0, alertnesstime=0
+        )
+        for userID in args[0]
+    ]
+
+
+# canned results that keep every command on its success path
+RESULTS = {
+    "econ_row": lambda args: _econ(args[0]),
+    "heist_target": lambda args: _record(userid=args[0], balance=10000, alertness=0, securitymodifier=0),
+    "portfolio": lambda args: [
+        _record(wallet=10000, wanted=0, banktype=bank, balance=100)
+        for bank in ("BWS", "LNC", "MMS", "RDI", "UC25")
+    ],
+    "bank_move": lambda args: _record(status="ok", minimumdeposit=1000, wallet=9000, account=1000),
+    "transfer": _transfer,
+    "transfer_from_bank": _transfer,
+    "ledger_recent": lambda args: [
+        _record(balancechange=150, balanceafter=10000, timestamp=args[0] + 60, reason="Passive Income"),
+        _record(balancechange=-50, balanceafter=9850, timestamp=args[0] + 30, reason="Transfer to someone"),
+    ],
+    "rank_all": lambda args: [
+        _record(userid=USER + i, balance=10000 - i, banktype="LNC", accountbalance=100 * i)
+        for i in range(3)
+    ],
+}
+
+
+class RecordingConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def _query(self, query, args):
+        name = _QUERY_NAMES.get(query, query)
+        self.pool.queries.append(name)
+        result = RESULTS.get(name)
+        return result(args) if result is not None else None
+
+    async def fetch(self, query, *args):
+        return await self._query(query, args) or []
+
+    async def fetchrow(self, query, *args):
+        return await self._query(query, args)
+
+    async def fetchval(self, query, *args):
+        row = await self._query(query, args)
+        return row[0] if isinstance(row, Record) else row
+
+    async def execute(self, query, *args):
+        await self._query(query, args)
+        return "OK"
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.pool.queries.append(f"COPY {table}")
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class RecordingPool:
+    """Stands in for asyncpg.Pool; counts checkouts and queries."""
+
+    def __init__(self):
+        self.queries = []
+        self.acquires = 0
+
+    async def acquire(self, timeout=None):
+        self.acquires += 1
+        return RecordingConnection(self)
+
+    async def release(self, conn):
+        pass
+
+    async def close(self):
+        pass
+
+    def get_min_size(self):
+        return 1
+
+    def get_max_size(self):
+        return 10
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1
+
+
+class Dice:
+    # lowest roll everywhere: no asset freeze, and the heist succeeds
+    @staticmethod
+    def randint(a, b):
+        return a
+
+    @staticmethod
+    def uniform(a, b):
+        return a
+
+
+class Response:
+    async def defer(self, *args, **kwargs):
+        pass
+
+    async def send_message(self, *args, **kwargs):
+        pass
+
+
+def _interaction():
+    async def send(*args, **kwargs):
+        pass
+
+    user = SimpleNamespace(
+        id=USER, name="robber",
+        display_avatar=SimpleNamespace(url="https://example.invalid/a.png"),
+        guild_permissions=SimpleNamespace(administrator=True)
+    )
+    return SimpleNamespace(user=user, response=Response(), followup=SimpleNamespace(send=send))
+
+
+COMMANDS = {
+    "ichirob": lambda target: (target,),
+    "ichiheist": lambda target: ("LNC", target),
+    "ichiportfolio": lambda target: (),
+    "ichiledger": lambda target: (),
+    "ichilb": lambda target: (),
+    "ichirank": lambda target: (target,),
+    "ichideposit": lambda target: ("LNC", 1000),
+    "ichiwithdraw": lambda target: ("LNC", 1000),
+    "ichitransfer": lambda target: (target, 100),
+}
+
+
+async def measure(command):
+    pool = RecordingPool()
+    db = Database(pool)
+
+    async def fetch_user(userID):
+        return SimpleNamespace(id=userID, name=f"user{userID}")
+
+    cog = economy.Economy(SimpleNamespace(db=db, fetch_user=fetch_user))
+    # only the command under test may touch the pool
+    for loop in (cog.refresh, cog.textcalcs, cog.archive):
+        loop.cancel()
+
+    target = SimpleNamespace(id=TARGET, name="target")
+    callback = getattr(cog, command).callback
+    await callback(cog, _interaction(), *COMMANDS[command](target))
+
+    measured = (len(pool.queries), pool.acquires, list(pool.queries))
+    await db.close()
+    return measured
+
+
+async def main():
+    economy.random = Dice
+    failed = False
+    for command, (trip_budget, acquire_budget) in BUDGETS.items():
+        trips, acquires, queries = await measure(command)
+        over = trips > trip_budget or acquires > acquire_budget
+        failed |= over
+        print(
+            f"{'FAIL' if over else 'ok':<5} {command:<14} "
+            f"round trips {trips}/{trip_budget}  acquires {acquires}/{acquire_budget}  "
+            f"{', '.join(queries)}"
+        )
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(main()) else 0)
@@ -0,0 +1,743 @@
+import asyncio
+import contextlib
+import functools
+import gzip
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import _WRITES, Database, heat, month_bounds
+from queries import QUERIES
+
+_PARAM = re.compile(r"\$(\d+)")
+_CAST = re.compile(r"::\w+(\[\])?")
+_FOR_UPDATE = re.compile(r"\s+FOR\s+UPDATE\b", re.IGNORECASE)
+
+# Registered queries whose Postgres text doesn't carry over to SQLite.
+# Everything else only needs its $n placeholders rewritten.
+SQLITE_QUERIES = {
+    # the bundled file predates the LuckModifier rename
+    "econ_row": "SELECT *, Luck AS LuckModifier FROM econ WHERE UserID = $1",
+    # archived months are already gzipped files under archive_dir, and
+    # UserID is stored as text
+    "ledger_export": """
+        SELECT CAST(UserID AS INTEGER), BalanceChange, BalanceAfter, Timestamp, Reason
+        FROM (
+            SELECT UserID, BalanceChange, BalanceAfter, Timestamp, Reason
+            FROM balancehistory
+            WHERE $1 IS NULL OR UserID = $1
+            UNION ALL
+            SELECT UserID, Amount, BalanceAfter, Timestamp, 'Passive Income'
+            FROM passiveincome
+            WHERE $1 IS NULL OR UserID = $1
+        ) AS ledger
+        ORDER BY Timestamp, CAST(UserID AS INTEGER)
+    """,
+    # $1 is a JSON array of ids, and there's no archive table to read
+    "ledger_check_batch": """
+        WITH users AS (
+            SELECT
+                e.UserID, e.Balance, c.HistoryID AS CheckedID, c.Bucket AS CheckedBucket,
+                c.BucketAmount AS CheckedAmount, c.Balance AS CheckedBalance
+            FROM econ e
+            LEFT JOIN ledgercheckpoints c ON c.UserID = e.UserID
+            WHERE e.UserID IN (SELECT value FROM json_each($1))
+        ), history AS (
+            SELECT
+                h.UserID,
+                SUM(h.BalanceChange) AS Delta,
+                SUM(CASE WHEN h.HistoryID > $2 THEN h.BalanceChange ELSE 0 END) AS Pending,
+                MAX(CASE WHEN h.HistoryID <= $2 THEN h.HistoryID END) AS LastID
+            FROM users u
+            JOIN balancehistory h
+                ON h.UserID = u.UserID AND h.HistoryID > COALESCE(u.CheckedID, 0)
+            GROUP BY h.UserID
+        ), passive AS (
+            SELECT
+                p.UserID,
+                SUM(p.Amount) - COALESCE(
+                    MAX(CASE WHEN p.Bucket = u.CheckedBucket THEN u.CheckedAmount END), 0
+                ) AS Delta,
+                MAX(p.Bucket) AS LastBucket
+            FROM users u
+            JOIN passiveincome p
+                ON p.UserID = u.UserID AND p.Bucket >= COALESCE(u.CheckedBucket, 0)
+            GROUP BY p.UserID
+        )
+        SELECT
+            u.UserID,
+            u.Balance,
+            COALESCE(u.CheckedBalance, 0) + COALESCE(h.Delta, 0) + COALESCE(p.Delta, 0) AS Expected,
+            COALESCE(h.Pending, 0) AS Pending,
+            u.CheckedBalance IS NOT NULL AS Checked,
+            COALESCE(u.CheckedID, 0) AS CheckedID,
+            COALESCE(u.CheckedBucket, 0) AS CheckedBucket,
+            MAX(COALESCE(u.CheckedID, 0), COALESCE(h.LastID, 0)) AS HistoryID,
+            COALESCE(p.LastBucket, u.CheckedBucket, 0) AS Bucket,
+            COALESCE(pb.Amount, u.CheckedAmount, 0) AS BucketAmount
+        FROM users u
+        LEFT JOIN history h ON h.UserID = u.UserID
+        LEFT JOIN passive p ON p.UserID = u.UserID
+        LEFT JOIN passiveincome pb ON pb.UserID = u.UserID AND pb.Bucket = p.LastBucket
+    """,
+}
+
+
+def _translate(query: str):
+    query = SQLITE_QUERIES.get(query) or QUERIES.get(query, query)
+    query = _FOR_UPDATE.sub("", query)
+    query = _CAST.sub("", query)
+    return _PARAM.sub(r"?\1", query)
+
+
+@functools.lru_cache(maxsize=256)
+def _column_index(columns):
+    return {name.lower(): i for i, name in enumerate(columns)}
+
+
+class Record:
+    """Row with positional and lowercase-name access, like asyncpg.Record."""
+
+    __slots__ = ("_values", "_index")
+
+    def __init__(self, values, index):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._index[key.lower()]]
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"<Record {dict(self.items())}>"
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return iter(self._values)
+
+    def items(self):
+        return ((k, self._values[i]) for k, i in self._index.items())
+
+    def get(self, key, default=None):
+        i = self._index.get(key.lower())
+        return default if i is None else self._values[i]
+
+
+def _record(cursor, row):
+    return Record(row, _column_index(tuple(d[0] for d in cursor.description)))
+
+
+def _floor(value):
+    return None if value is None else math.floor(value)
+
+
+def settle_interest(balance, rate, ticks):
+    """The hourly FLOOR(Balance * InterestRate), applied ticks times, as
+    the Postgres function of the same name."""
+    if balance is None or rate is None or ticks is None:
+        return balance
+    for _ in range(ticks):
+        settled = math.floor(balance * rate)
+        # and from here on every tick pays the same
+        if settled == balance:
+            break
+        balance = settled
+    return balance
+
+
+class _Cursor(sqlite3.Cursor):
+    def fetchone(self):
+        # a half-read statement keeps its read snapshot (and, on a reader,
+        # the old schema) open until the cursor is closed
+        row = super().fetchone()
+        self.close()
+        return row
+
+
+class _Connection(sqlite3.Connection):
+    def execute(self, sql, parameters=()):
+        return self.cursor(_Cursor).execute(sql, parameters)
+
+
+def _connect(path: str, readonly: bool):
+    conn = sqlite3.connect(
+        path, isolation_level=None, check_same_thread=False, factory=_Connection
+    )
+    conn.row_factory = _record
+    conn.execute("PRAGMA busy_timeout = 5000")
+    # not every sqlite build ships the math functions
+    conn.create_function("FLOOR", 1, _floor, deterministic=True)
+    conn.create_function("GREATEST", -1, max, deterministic=True)
+    conn.create_function("settle_interest", 3, settle_interest, deterministic=True)
+    conn.create_function("heat", 3, heat, deterministic=True)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    else:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+class SQLiteConnection:
+    """The slice of asyncpg's Connection API Database uses, run on one
+    sqlite connection through its executor."""
+
+    def __init__(self, executor, local):
+        self._executor = executor
+        self._local = local
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: fn(self._local.conn, *args)
+        )
+
+    async def execute(self, query: str, *args):
+        def run(conn):
+            cursor = conn.execute(_translate(query), args)
+            return f"{query.split()[0].upper()} {cursor.rowcount}"
+        return await self._call(run)
+
+    async def fetch(self, query: str, *args):
+        return await self._call(lambda conn: conn.execute(_translate(query), args).fetchall())
+
+    async def fetchrow(self, query: str, *args):
+        return await self._call(lambda conn: conn.execute(_translate(query), args).fetchone())
+
+    async def fetchval(self, query: str, *args):
+        row = await self.fetchrow(query, *args)
+        return None if row is None else row[0]
+
+
+class SQLiteDatabase(Database):
+    """Database on a local SQLite file (the bundled economy.db).
+
+    One writer thread owns the only connection that writes, so writes are
+    serialised without SQLite lock contention; reads go to a small pool of
+    reader threads, each with its own connection. WAL mode lets the readers
+    keep going while the writer commits.
+    """
+
+    dialect = "sqlite"
+
+    def __init__(self, path: str, readers: int = 4):
+        super().__init__(None)
+        self.path = path
+        self.archive_dir = os.getenv(
+            "LEDGER_ARCHIVE_DIR", os.path.join(os.path.dirname(path), "archive")
+        )
+        self._writer_local = threading.local()
+        self._reader_local = threading.local()
+        self._writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="sqlite-writer",
+            initializer=self._open, initargs=(self._writer_local, False)
+        )
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers,
+            thread_name_prefix="sqlite-reader",
+            initializer=self._open, initargs=(self._reader_local, True)
+        )
+        self._write_conn = SQLiteConnection(self._writer, self._writer_local)
+        self._read_conn = SQLiteConnection(self._readers, self._reader_local)
+        # held for every write, and for the whole of a transaction() block
+        self._write_lock = asyncio.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.write_wait = 0.0
+        self.max_write_wait = 0.0
+
+    @classmethod
+    async def open(cls, dsn: str):
+        # sqlite:///relative/path.db or sqlite:////absolute/path.db
+        path = dsn[len("sqlite:"):]
+        if path.startswith("///"):
+            path = path[3:]
+        elif path.startswith("//"):
+            path = path[2:]
+        if not os.path.exists(path):
+            raise RuntimeError(f"SQLite database {path} does not exist.")
+
+        db = cls(path, int(os.getenv("SQLITE_READERS", "4")))
+        # open the writer first so WAL mode is set before any reader connects
+        await db._write_conn.fetchval("PRAGMA journal_mode")
+        return db
+
+    async def warm_up(self, progress=None):
+        # start every reader thread (each opens its connection) and the
+        # writer; sqlite connections never go stale, so once is enough
+        if self.ready.is_set():
+            return
+        total = self._readers._max_workers + 1
+        done = 0
+        started = threading.Barrier(self._readers._max_workers)
+
+        def ping(conn):
+            started.wait(timeout=5)
+            return conn.execute("SELECT 1").fetchone()
+
+        async def check(connection, fn):
+            nonlocal done
+            await connection._call(fn)
+            done += 1
+            if progress is not None:
+                progress(done, total)
+
+        await asyncio.gather(
+            check(self._write_conn, lambda conn: conn.execute("SELECT 1").fetchone()),
+            *(check(self._read_conn, ping) for _ in range(self._readers._max_workers))
+        )
+        self.ready.set()
+
+    def _open(self, local, readonly):
+        local.conn = _connect(self.path, readonly)
+
+    @contextlib.asynccontextmanager
+    async def _write_slot(self):
+        requested = time.perf_counter()
+        async with self._write_lock:
+            wait = time.perf_counter() - requested
+            self.writes += 1
+            self.write_wait += wait
+            self.max_write_wait = max(self.max_write_wait, wait)
+            yield self._write_conn
+
+    async def _write(self, fn, *args):
+        # fn(conn, *args) runs on the writer thread inside one transaction
+        def run(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+        async with self._write_slot() as conn:
+            return await conn._call(run)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        async with self._write_slot() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            await conn.execute("COMMIT")
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        async with self._write_slot() as conn:
+            yield conn
+
+    async def _run(self, method: str, query: str, args, consistent: bool = True):
+        # one file, so every read is consistent
+        if _WRITES.search(SQLITE_QUERIES.get(query) or QUERIES.get(query, query)):
+            async with self._write_slot() as conn:
+                return await getattr(conn, method)(query, *args)
+
+        self.reads += 1
+        return await getattr(self._read_conn, method)(query, *args)
+
+    async def _stream(self, query: str, args, chunk_rows: int, consistent: bool = True):
+        # a connection of its own, so a long export doesn't tie up one of
+        # the reader threads between chunks
+        loop = asyncio.get_running_loop()
+        conn = await loop.run_in_executor(None, _connect, self.path, True)
+        try:
+            cursor = await loop.run_in_executor(None, conn.execute, _translate(query), args)
+            while True:
+                rows = await loop.run_in_executor(None, cursor.fetchmany, chunk_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await loop.run_in_executor(None, conn.close)
+
+    async def sequential_scans(self, query: str, *args):
+        query = _translate(query)
+
+        def explain(_):
+            # a fresh connection: the readers' statement caches keep plans
+            # for EXPLAIN made before the latest DDL
+            conn = _connect(self.path, readonly=True)
+            try:
+                return conn.execute("EXPLAIN QUERY PLAN " + query, args).fetchall()
+            finally:
+                conn.close()
+
+        plan = await self._read_conn._call(explain)
+        details = [row["detail"] for row in plan]
+        # "SCAN t" is a full read of t, unless t is a subquery sqlite has
+        # already built ("CO-ROUTINE t" / "MATERIALIZE t"); "SCAN t USING
+        # INDEX" walks an index
+        subqueries = {
+            detail.split()[1]
+            for detail in details
+            if detail.startswith(("CO-ROUTINE ", "MATERIALIZE "))
+        }
+        return [
+            detail.split()[1]
+            for detail in details
+            if detail.startswith("SCAN ") and " USING " not in detail
+            and detail.split()[1] not in subqueries
+        ]
+
+    def stats(self):
+        stats = {
+            "backend": "sqlite",
+            "path": self.path,
+            "readers": self._readers._max_workers,
+            "reads": self.reads,
+            "writes": self.writes,
+            "write_waiting": len(self._write_lock._waiters or ()),
+            "write_wait_avg_ms": round(self.write_wait * 1000 / self.writes, 3) if self.writes else 0.0,
+            "write_wait_max_ms": round(self.max_write_wait * 1000, 3),
+            "cache": self.cache.snapshot(),
+            "ranks": self.ranks.snapshot(),
+        }
+        if self.ledger is not None:
+            stats["ledger"] = self.ledger.snapshot()
+        return stats
+
+    async def _insert_ledger(self, rows):
+        await self._write(lambda conn: conn.executemany(_INSERT_LEDGER, rows))
+
+    async def _apply_change_balance(self, userID, value, reason, time, ledger):
+        return await self._write(_change_balance, userID, value, reason, time, ledger)
+
+    async def _apply_change_balances(self, changes, ledger):
+        def run(conn):
+            balances = {}
+            for userID, value, reason, at in changes:
+                balances[userID] = _change_balance(conn, userID, value, reason, at, ledger)
+            return balances
+        return await self._write(run)
+
+    async def _check_batch(self, userIDs, horizon):
+        return await self.fetchall("ledger_check_batch", json.dumps(userIDs), horizon)
+
+    async def _save_checkpoints(self, rows, now):
+        if not rows:
+            return
+        await self._write(lambda conn: conn.executemany(
+            """
+            INSERT INTO ledgercheckpoints
+                (UserID, HistoryID, Bucket, BucketAmount, Balance, CheckedAt)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (UserID) DO UPDATE SET
+                HistoryID = excluded.HistoryID,
+                Bucket = excluded.Bucket,
+                BucketAmount = excluded.BucketAmount,
+                Balance = excluded.Balance,
+                CheckedAt = excluded.CheckedAt
+            """,
+            [
+                (
+                    r["userid"], r["historyid"], r["bucket"], r["bucketamount"],
+                    r["balance"] - r["pending"], int(now)
+                )
+                for r in rows
+            ]
+        ))
+
+    async def _archive_batch(self, cutoff, limit):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        return await self._write(_archive_batch, cutoff, limit, self.archive_dir)
+
+    async def _settle_batch(self, after, limit):
+        return await self._write(_settle_stale, after, limit)
+
+    async def ledger_partitions(self):
+        def run(conn):
+            partitions = [{
+                "name": "balancehistory",
+                "rows": conn.execute("SELECT COUNT(*) FROM balancehistory").fetchone()[0],
+                "bytes": None,
+            }]
+            try:
+                partitions[0]["bytes"] = conn.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name = 'balancehistory'"
+                ).fetchone()[0]
+            except sqlite3.OperationalError:
+                # built without the dbstat table
+                pass
+            for month, path, rows in conn.execute(
+                "SELECT Month, Path, Rows FROM ledgerarchive ORDER BY Month"
+            ).fetchall():
+                partitions.append({
+                    "name": os.path.basename(path),
+                    "rows": rows,
+                    "bytes": os.path.getsize(path) if os.path.exists(path) else None,
+                })
+            return partitions
+        return await self._read_conn._call(run)
+
+    async def _apply_passive_income(self, credits, bucket, time):
+        return await self._write(_passive_income, credits, bucket, time)
+
+    async def _apply_transfer(self, participants, fromID, amount, check_funds, time, bank, ledger):
+        return await self._write(
+            _transfer, participants, fromID, amount, check_funds, time, bank, ledger
+        )
+
+    async def _apply_bank_move(self, userID, bank, deposit, time, isRob, reason, ledger):
+        return await self._write(_bank_move, userID, bank, deposit, time, isRob, reason, ledger)
+
+    async def close(self):
+        if self.ledger is not None:
+            await self.ledger.close()
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+
+# The mutations below run on the writer thread inside _write()'s transaction.
+# They mirror the single-statement Postgres versions in queries.py, ledger
+# flag included.
+
+_INSERT_LEDGER = """
+    INSERT INTO balancehistory
+        (UserID, BalanceChange, BalanceAfter, Timestamp, Reason)
+    VALUES (?1, ?2, ?3, ?4, ?5)
+"""
+
+
+def _change_balance(conn, userID, value, reason, time, ledger):
+    balance = conn.execute(
+        """
+        INSERT INTO econ (UserID, Balance) VALUES (?1, ?2)
+        ON CONFLICT (UserID) DO UPDATE SET Balance = Balance + excluded.Balance
+        RETURNING Balance
+        """,
+        (userID, value)
+    ).fetchone()[0]
+    if ledger:
+        conn.execute(_INSERT_LEDGER, (userID, value, balance, time, reason))
+    return balance
+
+
+def _passive_income(conn, credits, bucket, time):
+    balances = {}
+    for userID, amount in credits:
+        balances[userID] = _change_balance(conn, userID, amount, None, time, False)
+        conn.execute(
+            """
+            INSERT INTO passiveincome
+                (UserID, Bucket, Amount, Credits, BalanceAfter, Timestamp)
+            VALUES (?1, ?2, ?3, 1, ?4, ?5)
+            ON CONFLICT (UserID, Bucket) DO UPDATE SET
+                Amount = Amount + excluded.Amount,
+                Credits = Credits + 1,
+                BalanceAfter = excluded.BalanceAfter,
+                Timestamp = excluded.Timestamp
+            """,
+            (userID, bucket, amount, balances[userID], time)
+        )
+    return balances
+
+
+def _archive_batch(conn, cutoff, limit, directory):
+    rows = conn.execute(
+        """
+        SELECT HistoryID, UserID, BalanceChange, BalanceAfter, Timestamp, Reason
+        FROM balancehistory
+        WHERE Timestamp < ?1
+        ORDER BY Timestamp
+        LIMIT ?2
+        """,
+        (cutoff, limit)
+    ).fetchall()
+
+    months = {}
+    for row in rows:
+        months.setdefault(month_bounds(row[4])[2], []).append(list(row))
+    # the file is written before the delete commits: a crash in between
+    # can leave a row in both places, never in neither
+    for month, month_rows in months.items():
+        path = os.path.join(directory, f"balancehistory_{month}.jsonl.gz")
+        with gzip.open(path, "at") as f:
+            f.writelines(json.dumps(row) + "\n" for row in month_rows)
+        conn.execute(
+            """
+            INSERT INTO ledgerarchive (Month, Path, Rows) VALUES (?1, ?2, ?3)
+            ON CONFLICT (Month) DO UPDATE SET Rows = Rows + excluded.Rows
+            """,
+            (month, path, len(month_rows))
+        )
+    conn.executemany(
+        "DELETE FROM balancehistory WHERE HistoryID = ?1", [(row[0],) for row in rows]
+    )
+    return len(rows)
+
+
+def _settle(conn, userID, bank):
+    # pays the account the interest it's owed before it's changed
+    conn.execute(
+        """
+        UPDATE bankaccounts
+        SET (Balance, Gain, Loss, SettledTick) = (
+            SELECT Balance, Gain, Loss, SettledTick
+            FROM bankaccounts_live
+            WHERE UserID = ?1 AND BankType = ?2
+        )
+        WHERE UserID = ?1 AND BankType = ?2
+        """,
+        (userID, bank)
+    )
+
+
+def _settle_stale(conn, after, limit):
+    # _settle for the limit accounts furthest behind the interest clock,
+    # as long as that's at least after ticks
+    return conn.execute(
+        """
+        UPDATE bankaccounts
+        SET (Balance, Gain, Loss, SettledTick) = (
+            SELECT l.Balance, l.Gain, l.Loss, l.SettledTick
+            FROM bankaccounts_live l
+            WHERE l.UserID = bankaccounts.UserID AND l.BankType = bankaccounts.BankType
+        )
+        WHERE (UserID, BankType) IN (
+            SELECT ba.UserID, ba.BankType
+            FROM bankaccounts ba
+            JOIN interestclock c ON c.ID = 1
+            WHERE ba.SettledTick <= c.Tick - ?1
+            ORDER BY ba.SettledTick
+            LIMIT ?2
+        )
+        """,
+        (after, limit)
+    ).rowcount
+
+
+def _transfer(conn, participants, fromID, amount, check_funds, time, bank, ledger):
+    if bank is None:
+        held = conn.execute("SELECT Balance FROM econ WHERE UserID = ?1", (fromID,)).fetchone()
+    else:
+        _settle(conn, fromID, bank)
+        held = conn.execute(
+            "SELECT Balance FROM bankaccounts WHERE UserID = ?1 AND BankType = ?2",
+            (fromID, bank)
+        ).fetchone()
+
+    if check_funds and (held[0] if held else 0) < amount:
+        return [{"ok": False, "accountbalance": None}]
+
+    account = None
+    if bank is not None:
+        account = conn.execute(
+            """
+            UPDATE bankaccounts SET Balance = Balance - ?1
+            WHERE UserID = ?2 AND BankType = ?3
+            RETURNING Balance
+            """,
+            (amount, fromID, bank)
+        ).fetchone()
+        account = account[0] if account else None
+
+    rows = []
+    for userID, delta, reason, wantedness, alertness, stealtime in participants:
+        row = conn.execute(
+            """
+            INSERT INTO econ
+                (UserID, Balance, Wantedness, Alertness, LastStealTime, WantednessTime, AlertnessTime)
+            VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?6)
+            ON CONFLICT (UserID) DO UPDATE SET
+                Balance = Balance + excluded.Balance,
+                Wantedness = CASE
+                    WHEN excluded.Wantedness = 0 THEN Wantedness
+                    ELSE heat(Wantedness, WantednessTime, ?6) + excluded.Wantedness
+                END,
+                WantednessTime = CASE WHEN excluded.Wantedness = 0 THEN WantednessTime ELSE ?6 END,
+                Alertness = CASE
+                    WHEN excluded.Alertness = 0 THEN Alertness
+                    ELSE heat(Alertness, AlertnessTime, ?6) + excluded.Alertness
+                END,
+                AlertnessTime = CASE WHEN excluded.Alertness = 0 THEN AlertnessTime ELSE ?6 END,
+                LastStealTime = MAX(LastStealTime, excluded.LastStealTime)
+            RETURNING Balance, Wantedness, Alertness, LastStealTime, WantednessTime, AlertnessTime
+            """,
+            (userID, delta, wantedness, alertness, stealtime, time)
+        ).fetchone()
+        if ledger and reason is not None:
+            conn.execute(_INSERT_LEDGER, (userID, delta, row[0], time, reason))
+        rows.append({
+            "ok": True,
+            "accountbalance": account,
+            "userid": userID,
+            "balance": row[0],
+            "wantedness": row[1],
+            "alertness": row[2],
+            "laststealtime": row[3],
+            "wantednesstime": row[4],
+            "alertnesstime": row[5],
+        })
+    return rows
+
+
+def _bank_move(conn, userID, bank, deposit, time, isRob, reason, ledger):
+    limits = conn.execute(
+        "SELECT MinimumDepositTime, MinimumDeposit FROM banks WHERE ShortName = ?1",
+        (bank,)
+    ).fetchone()
+    result = {"status": "ok", "minimumdeposit": None, "wallet": None, "account": None}
+    if limits is None:
+        result["status"] = "bank"
+        return result
+    min_cooldown, min_deposit = limits
+    result["minimumdeposit"] = min_deposit
+
+    wallet = conn.execute("SELECT Balance FROM econ WHERE UserID = ?1", (userID,)).fetchone()
+    wallet = (wallet[0] if wallet else 0) or 0
+    _settle(conn, userID, bank)
+    account = conn.execute(
+        "SELECT Balance, LastDepositTime FROM bankaccounts WHERE UserID = ?1 AND BankType = ?2",
+        (userID, bank)
+    ).fetchone()
+    balance, last_deposit = account if account else (0, 0)
+    last_deposit = last_deposit or 0
+
+    if deposit < 0 and not isRob and time - last_deposit < min_cooldown:
+        result["status"] = "cooldown"
+    elif 0 < deposit < min_deposit:
+        result["status"] = "minimum"
+    elif balance + deposit < 0 or (not isRob and wallet < deposit):
+        result["status"] = "funds"
+    if result["status"] != "ok":
+        return result
+
+    if not isRob:
+        result["wallet"] = _change_balance(conn, userID, -deposit, reason, time, ledger)
+
+    result["account"] = conn.execute(
+        """
+        INSERT INTO bankaccounts (UserID, BankType, Balance, LastDepositTime, SettledTick)
+        VALUES (?1, ?2, ?3, ?4, (SELECT Tick FROM interestclock WHERE ID = 1))
+        ON CONFLICT (UserID, BankType) DO UPDATE SET
+            Balance = Balance + excluded.Balance,
+            LastDepositTime = CASE
+                WHEN excluded.Balance > 0 THEN excluded.LastDepositTime
+                ELSE LastDepositTime
+            END
+        RETURNING Balance
+        """,
+        (userID, bank, deposit, time)
+    ).fetchone()[0]
+    return result